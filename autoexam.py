@@ -8,6 +8,7 @@ import shutil
 import json
 import os.path
 import glob
+import collections
 
 if 'AUTOEXAM_FOLDER' not in os.environ:
     path = os.path.dirname(os.path.realpath(__file__))
@@ -35,6 +36,9 @@ def is_project_folder():
 
 def generate(args):
     import gen
+    import texbuild
+    import timings
+    import scanresults
 
     if not check_project_folder():
         return
@@ -53,68 +57,428 @@ def generate(args):
         args.dont_generate_text = True
         args.dont_generate_master = True
 
+    if args.max_overlap is not None and args.batch:
+        error("--max-overlap can't be used with --batch.")
+        return
+
+    # Checked before the version is created, which a missing template
+    # would otherwise leave empty.
+    for template in [args.answer_template, args.master_template,
+                     args.text_template, args.solution_template]:
+        if not os.path.isfile(template):
+            error("Template `{0}` does not exist.".format(template))
+            return
+
     name = get_project_option('name')
-    test_id = int(get_project_option('next_version'))
+    indices = None
+    build_folder = None
+
+    if args.tests:
+        if not args.regenerate:
+            error("Only tests of an existing version can be picked.\nUse --tests with --regenerate.")
+            return
+
+        if args.single_document:
+            error("--tests can't be used with --single-document.\n"
+                  "The single documents hold every test of the version.")
+            return
+
+        indices = parse_indices(args.tests)
+
+    if args.version is not None and (not args.shard or args.regenerate):
+        error("--version is only used with --shard, for versions not generated here.")
+        return
+
+    if args.shard:
+        if args.tests:
+            error("--shard and --tests can't be used together.")
+            return
+
+        if args.regenerate is None and args.version is None:
+            error("All the shards of a version must be generated for the same version.\n"
+                  "Please pass it with --version, or with --regenerate if it exists here.")
+            return
+
+        try:
+            shard, shards = parse_shard(args.shard)
+        except ValueError:
+            error("Invalid shard `{0}`. Use k/n, with k from 1 to n.".format(args.shard))
+            return
+
+        if args.regenerate is None and not args.tests_count:
+            error("The tests of the version are split into the shards.\n"
+                  "Please pass how many there are with --tests-count.")
+            return
+
+    if args.regenerate:
+        test_id = args.regenerate
+        old_folder = os.path.join('generated', 'v{0}'.format(test_id))
+
+        if not os.path.exists(old_folder):
+            error("Version {0} does not exist.".format(test_id))
+            return
+
+        if os.path.exists(os.path.join(old_folder, 'results.json')):
+            error("Version {0} has already been scanned.\nRefusing to overwrite it.".format(test_id))
+            return
+
+        if not reuse_options(args, old_folder, test_id):
+            return
+
+        count = len(scanresults.parse(os.path.join(old_folder, 'order.json')) or {})
+
+        if not args.tests_count:
+            args.tests_count = count
+        elif args.tests_count != count:
+            error("Version {0} has {1} tests, not {2}.\n"
+                  "Leave out --tests-count to generate all of them again.".format(test_id, count, args.tests_count))
+            return
+
+        if args.shard:
+            if not count:
+                error("Version {0} has no tests to split into shards.".format(test_id))
+                return
+
+            indices = gen.shard_indices(args.tests_count, shard, shards, args.answers_per_page)
+
+        if args.tests:
+            missing = [i for i in indices if i >= count]
+
+            if missing:
+                error("Version {0} has no test {1}.\n"
+                      "Its tests go from 0 to {2}.".format(test_id, missing[0], count - 1))
+                return
 
-    print("Generating project `{0}`".format(name))
+            # The answer sheets of a page are written together, so the
+            # rest of the tests of their pages are generated again too.
+            indices = gen.page_indices(indices, count, args.answers_per_page)
 
-    gen.test_id = test_id
-    set_project_option('next_version', test_id + 1)
+            # The single documents of the version would no longer match
+            # the tests generated again.
+            for document in ['Answers', 'Tests']:
+                stale = glob.glob(os.path.join(old_folder, '*', document + '.*'))
 
-    os.mkdir(os.path.join('generated', 'v{0}'.format(test_id)))
+                if stale:
+                    warn("Removed {0}.pdf, which held the old tests.\n"
+                         "Run `autoexam gen -r {1} --single-document keep` to build it again.".format(document, test_id))
 
-    gen.parser(args.master)
-    gen.generate(args.tests_count, args)
+                for f in stale:
+                    os.remove(f)
 
-    print("Compiling LaTeX source files")
+        if args.seed is None:
+            args.seed = read_seed(old_folder)
+
+        print("Regenerating version {0} of project `{1}`".format(test_id, name))
+
+        if indices is None:
+            # The version is built apart and only replaces the old one
+            # once it is complete.
+            build_folder = os.path.join('generated', '.v{0}-new'.format(test_id))
+
+            if os.path.exists(build_folder):
+                shutil.rmtree(build_folder)
+
+            os.mkdir(build_folder)
+    elif args.shard:
+        # Every shard goes into the version given, which is neither
+        # taken from nor made the last version of this project.
+        test_id = args.version
+        folder = os.path.join('generated', 'v{0}'.format(test_id))
+
+        if os.path.exists(os.path.join(folder, 'results.json')):
+            error("Version {0} has already been scanned.\nRefusing to overwrite it.".format(test_id))
+            return
+
+        if not reuse_options(args, folder, test_id):
+            return
+
+        indices = gen.shard_indices(args.tests_count, shard, shards, args.answers_per_page)
+
+        if args.seed is None and os.path.exists(os.path.join(folder, 'seed')):
+            args.seed = read_seed(folder)
+
+        if args.seed is None:
+            error("All the shards of a version must use the same seed.\nPlease pass it with --seed.")
+            return
+
+        print("Generating shard {0} of version {1} of project `{2}`".format(args.shard, test_id, name))
+
+        if not os.path.exists(folder):
+            os.mkdir(folder)
+
+        # So later versions generated here don't take its number.
+        if test_id >= int(get_project_option('next_version')):
+            set_project_option('next_version', test_id + 1)
+    else:
+        test_id = int(get_project_option('next_version'))
+        print("Generating project `{0}`".format(name))
+        set_project_option('next_version', test_id + 1)
+        os.mkdir(os.path.join('generated', 'v{0}'.format(test_id)))
+
+    timer = timings.Timings()
+
+    with timer.phase('parse'):
+        bank = gen.parser(args.master)
 
     gen_folder = os.path.join('generated', 'v' + str(test_id))
+    build_folder = build_folder or gen_folder
 
     def dst(path):
-        return os.path.join(gen_folder, path)
+        return os.path.join(build_folder, path)
 
-    os.chdir(gen_folder)
+    cache = None
 
-    for f in os.listdir('.'):
-        if f.endswith('.tex'):
-            os.system("pdflatex %s -interaction=nonstopmode > compile_latex.log" % f)
+    if args.regenerate and not args.no_build_cache:
+        # The PDFs of the files that didn't change are reused from the
+        # previous build of the version, through a temporary cache.
+        cache = os.path.abspath(os.path.join('generated', '.v{0}-cache'.format(test_id)))
+
+        if os.path.exists(cache):
+            shutil.rmtree(cache)
 
-    os.mkdir('pdf')
-    os.mkdir('src')
-    os.mkdir('log')
+        texbuild.cache_version(gen_folder, cache)
+
+    dst_image_dir = dst('images')
+    if not os.path.exists(dst_image_dir):
+        os.mkdir(dst_image_dir)
+        print 'Created images directory'
+
+    if args.single_document:
+        gen.generate(bank, args.tests_count, args, test_id, indices,
+                     folder=build_folder, timer=timer)
+
+        print("Compiling LaTeX source files")
+
+        try:
+            sources, failed, unsplit, parts = compile_single_document(args, build_folder, cache, timer)
+        finally:
+            if cache:
+                shutil.rmtree(cache)
+
+        if sources is None:
+            return
+
+        total = len(sources)
+    else:
+        # Each file is compiled as soon as it is written, and the answer
+        # sheets rasterized as soon as they compile.
+        print("Generating and compiling LaTeX source files")
+
+        pipeline = texbuild.Pipeline(args.jobs, args.precompile_preamble, cache,
+                                     os.path.abspath(dst_image_dir), [dst('Master.tex')], timer)
+
+        try:
+            gen.generate(bank, args.tests_count, args, test_id, indices, pipeline.put,
+                         build_folder, timer)
+        finally:
+            failed = [os.path.basename(f) for f in pipeline.close()]
+
+            if cache:
+                shutil.rmtree(cache)
+
+        if pipeline.stopped:
+            error("Master.tex failed to compile, skipping the tests.\n"
+                  "See `{0}` for details.".format(dst(texbuild.log_path('Master.tex'))))
+            return
+
+        total = pipeline.count
+        unsplit, parts = [], 0
+
+    os.chdir(build_folder)
+
+    for d in ['pdf', 'src', 'log']:
+        if not os.path.exists(d):
+            os.mkdir(d)
 
     for f in os.listdir('.'):
         if f.endswith('.pdf'):
-            shutil.move(f, 'pdf')
+            shutil.move(f, os.path.join('pdf', f))
         elif f.endswith('.log'):
-            shutil.move(f, 'log')
+            shutil.move(f, os.path.join('log', f))
         elif f.endswith('.tex') or f.endswith('.png'):
-            shutil.move(f, 'src')
+            shutil.move(f, os.path.join('src', f))
         elif f.endswith('.aux'):
             os.remove(f)
 
     os.chdir('..')
 
-    if os.path.exists('last'):
-        os.remove('last')
+    if not args.regenerate and not args.shard:
+        if os.path.exists('last'):
+            os.remove('last')
 
-    os.symlink('v' + str(test_id), 'last')
-
-    print("Test generated successfully")
+        os.symlink('v' + str(test_id), 'last')
 
     os.chdir('..')
 
-    dst_image_dir = os.path.join('generated', 'last', 'images')
-    if not os.path.exists(dst_image_dir):
-        os.mkdir(dst_image_dir)
-        print 'Created images directory'
-    file_list = glob.glob('generated/last/pdf/Answer*')
-    for i, filename in enumerate(file_list):
-        os.system('pdftocairo -jpeg {filename} {dst_image_dir}/{i}-scan'
-            .format(filename=filename, dst_image_dir=dst_image_dir, i=i))
+    if args.single_document:
+        file_list = glob.glob(os.path.join(build_folder, 'pdf', 'Answer*'))
+        for filename in file_list:
+            texbuild.rasterize(filename, dst_image_dir, timer)
 
     print("Added empty pictures into images folder for debugging.")
 
+    timer.dump(dst('timings.json'))
+
+    if args.timings:
+        print(timer.report())
+
+    def shown(files):
+        return "\n  ".join(files[:10] + (['...'] if len(files) > 10 else []))
+
+    if failed:
+        warn("{0} of {1} files failed to compile:\n  {2}\n"
+             "See the logs in `{3}`.".format(len(failed), total,
+                                              shown(failed), dst('log')))
+
+    if unsplit:
+        warn("{0} of {1} sheets could not be split out of the single documents:\n  {2}\n"
+             "The single documents were kept in `{3}`.".format(len(unsplit), parts,
+                                                               shown(unsplit), dst('pdf')))
+
+    if failed or unsplit:
+        if build_folder != gen_folder:
+            warn("Version {0} was left untouched.\n"
+                 "The new build is in `{1}`.".format(test_id, build_folder))
+    else:
+        if build_folder != gen_folder:
+            replace_folder(gen_folder, build_folder)
+
+        print("Test generated successfully")
+
+
+def replace_folder(folder, new_folder):
+    """Puts `new_folder` in the place of `folder`, which is only removed
+    once the new one is in place."""
+    old_folder = os.path.join(os.path.dirname(folder), '.' + os.path.basename(folder) + '-old')
+
+    if os.path.exists(old_folder):
+        shutil.rmtree(old_folder)
+
+    os.rename(folder, old_folder)
+    os.rename(new_folder, folder)
+    shutil.rmtree(old_folder)
+
+
+def compile_single_document(args, gen_folder, cache, timer):
+    """Compiles the sources of `gen_folder` in --single-document mode.
+    Returns the files compiled, those that failed, the sheets that could
+    not be split out of the single documents and how many sheets were
+    split, or None for all of them if Master.tex failed to compile."""
+    import texbuild
+
+    def dst(path):
+        return os.path.join(gen_folder, path)
+
+    os.chdir(gen_folder)
+
+    try:
+        sources = sorted(f for f in os.listdir('.') if f.endswith('.tex'))
+
+        if 'Master.tex' in sources:
+            sources.remove('Master.tex')
+
+            if texbuild.compile_all(['Master.tex'], cache=cache, timer=timer):
+                error("Master.tex failed to compile, skipping the tests.\n"
+                      "See `{0}` for details.".format(dst(texbuild.log_path('Master.tex'))))
+                return None, None, None, None
+
+        combined = texbuild.combine_sources(sources)
+
+        for parts in combined.values():
+            sources = [f for f in sources if f not in parts]
+
+        sources += sorted(combined)
+
+        failed = texbuild.compile_all(sources, args.jobs, args.precompile_preamble, cache, timer)
+        unsplit = []
+        split = 0
+
+        for name, parts in sorted(combined.items()):
+            if name in failed:
+                continue
+
+            if args.single_document == 'split':
+                missing = texbuild.split_pdf(name, parts, args.jobs)
+                unsplit += missing
+                split += len(parts)
+
+                # Kept whenever some part is missing, so no sheet is lost.
+                if not missing:
+                    os.remove(os.path.splitext(name)[0] + '.pdf')
+
+        return sources, failed, unsplit, split
+    finally:
+        os.chdir(os.path.join('..', '..'))
+
+
+def parse_indices(spec):
+    """Parses a list of test numbers like `3,7-9` into [3, 7, 8, 9]."""
+    indices = []
+
+    for part in spec.split(','):
+        first, _, last = part.partition('-')
+        indices.extend(range(int(first), int(last or first) + 1))
+
+    return sorted(set(indices))
+
+
+def parse_shard(spec):
+    """Parses a shard like `2/4` into (2, 4)."""
+    shard, _, shards = spec.partition('/')
+    shard, shards = int(shard), int(shards)
+
+    if not 1 <= shard <= shards:
+        raise ValueError(spec)
+
+    return shard, shards
+
+
+def read_seed(folder):
+    with open(os.path.join(folder, 'seed')) as fp:
+        return int(fp.read())
+
+
+def read_options(folder):
+    """Returns the options version `folder` was generated with, or None if
+    it doesn't have them saved."""
+    path = os.path.join(folder, 'options.json')
+
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def reuse_options(args, folder, test_id):
+    """Sets in `args` the options version `folder` was generated with, so
+    its tests come out the same. Returns False if one of them was given a
+    different value."""
+    import gen
+
+    for name, value in sorted((read_options(folder) or {}).items()):
+        given = getattr(args, name)
+
+        if given == value:
+            continue
+
+        if given != gen.VERSION_OPTIONS[name]:
+            option = '--' + name.replace('_', '-')
+
+            if isinstance(value, bool):
+                used = "without " + option
+            else:
+                used = "with {0} {1}".format(option, value)
+
+            error("Version {0} was generated {1}.\n"
+                  "Leave out {2} to generate it the same way.".format(test_id, used, option))
+            return False
+
+        setattr(args, name, value)
+
+    return True
+
+
 def new(args):
     if is_project_folder():
         error("This project is already initialized.\nPlease run this outside this folder.")
@@ -164,7 +528,7 @@ def new(args):
 def scan(args):
     import beep
     import cv2
-    from autotest import TestScanner, ImageSource
+    from autotest import TestScanner, ImageSource, ScanWorkers
     from evaluator import get_stats
     import scanresults
     import json
@@ -175,36 +539,25 @@ def scan(args):
         error('Not an Autoexam folder or exams not generated')
         return
 
+    if args.batch:
+        scan_batch(args)
+        return
+
     source = ImageSource(args.cameras if args.folder == ""
                          else args.folder, args.time)
     w, h = source.get_size()
 
     print('Initializing scanner...')
 
-    #Set document processing parameters and initialize scanner
-    scanner = TestScanner(w, h, args.exams_file, show_image=True,
-                          double_check=True, debug=args.debug,
-                          poll=args.poll)
+    #the first scan of each test is kept, whatever the camera
+    sink = scanresults.ResultSink()
+    tests = sink.tests
 
-    tests = {}
-
-    while True:
-        #While user does not press the q key if it is a camera
-        if source.is_camera:
-            if (cv2.waitKey(100) & 0xFF) == ord('q'):
-                print('Camera finished!')
-                break
-        elif source.finished:
-            print('Folder finished!')
-            break
-
-        #Get the scan report of the source image
-        report = scanner.scan(source)
+    def on_scan(report):
         #if test recognized OK
         if report.success:
-            if not report.test.id in tests:
+            if sink.add(report.test):
                 beep.beep()
-                tests[report.test.id] = report.test
                 print "Test ID:", unicode(report.test.id).encode("utf8")
                 for i, q in enumerate(report.test.questions):
                     print "%d. %s" % (i+1, q)
@@ -212,7 +565,6 @@ def scan(args):
                     print "Warnings:"
                     for w in report.test.warnings:
                         print "\t", w
-                # on_scan(report)
                 #this method appends the test results if the file exists...
                 if args.autowrite:
                     scanresults.dump(tests, args.outfile, overwrite=False)
@@ -226,15 +578,51 @@ def scan(args):
                 print "The test '%d' was already scanned." % report.test.id
         #if recognition went wrong print the reasons
         else:
-            # show only the question detection errors and the
-            # errors in the format of the qrcodes
+            # show only the question detection errors, the errors in
+            # the format of the qrcodes and the images that failed
             for e in [x for x in report.errors
-                      if isinstance(x, scanresults.QuestionError) or
+                      if isinstance(x, (scanresults.QuestionError, scanresults.ScanError)) or
                       (isinstance(x, scanresults.QrcodeError) and x.err_type == scanresults.QRCodeErrorTypes.FORMAT) or args.debug]:
                 print e
-            # on_scan(report)
 
-    scanner.finalize()
+    if source.is_camera and not args.debug:
+        #every camera is read in its own thread and its frames are
+        #recognized by its own threads, the main thread only shows them
+        workers = ScanWorkers(source.sources, args.jobs, args.exams_file,
+                              double_check=True, headless=True, poll=args.poll)
+
+        #While user does not press the q key
+        while (cv2.waitKey(30) & 0xFF) != ord('q'):
+            source.show()
+            for report in workers.ready():
+                on_scan(report)
+
+        print('Camera finished!')
+        workers.stop()
+        for report in workers.ready():
+            on_scan(report)
+    else:
+        #Set document processing parameters and initialize scanner
+        scanner = TestScanner(w, h, args.exams_file, show_image=True,
+                              double_check=True, debug=args.debug,
+                              poll=args.poll)
+
+        while True:
+            #While user does not press the q key if it is a camera
+            if source.is_camera:
+                source.show()
+                if (cv2.waitKey(100) & 0xFF) == ord('q'):
+                    print('Camera finished!')
+                    break
+            elif source.finished:
+                print('Folder finished!')
+                break
+
+            #Get the scan report of the source image
+            on_scan(scanner.scan(source))
+
+        scanner.finalize()
+
     source.release()
 
     #this method appends the test results if the file exists...
@@ -245,6 +633,64 @@ def scan(args):
     cv2.waitKey()
 
 
+def scan_batch(args):
+    from autotest import scan_folder
+    import scanresults
+
+    if not args.folder:
+        error("The batch mode scans a folder of images.\nPlease pass it with --folder.")
+        return
+
+    print('Initializing scanners...')
+
+    tests = {}
+    images = {}
+    failures = collections.defaultdict(list)
+
+    #the reports come in the order of the file names, so the first image
+    #of each test is kept, whatever the number of workers
+    for filename, report in scan_folder(args.folder, args.exams_file, args.jobs, poll=args.poll):
+        name = os.path.basename(filename)
+
+        if report is None:
+            errors = ['Could not read the image']
+        elif report.success:
+            errors = []
+        else:
+            errors = [str(e) for e in report.errors] or ['The test could not be recognized']
+
+        test = report.test.id if report and report.test else None
+        images[name] = dict(test=test, errors=errors)
+
+        if errors:
+            failures[errors[0]].append(name)
+            print("%s: FAILED, %s" % (name, errors[0]))
+        elif test in tests:
+            images[name]['duplicate'] = True
+            print("%s: test %d, already scanned" % (name, test))
+        else:
+            tests[test] = report.test
+            print("%s: test %d" % (name, test))
+            for w in report.test.warnings:
+                print("\t%s" % w)
+
+    #this method appends the test results if the file exists...
+    scanresults.dump(tests, args.outfile, overwrite=False)
+
+    images_path = os.path.splitext(args.outfile)[0] + '-images.json'
+    with open(images_path, 'w') as fp:
+        json.dump(images, fp, indent=4, sort_keys=True)
+
+    failed = sum(len(names) for names in failures.values())
+    print("%d images scanned, %d tests recognized, %d images failed." % (len(images), len(tests), failed))
+
+    for reason, names in sorted(failures.items(), key=lambda f: -len(f[1])):
+        shown = names[:10] + (['...'] if len(names) > 10 else [])
+        warn("{0} images: {1}\n  {2}".format(len(names), reason, "\n  ".join(shown)))
+
+    print("The result of each image was saved to %s" % images_path)
+
+
 callables = []
 
 
@@ -441,6 +887,68 @@ def get_base_path(args):
         return os.path.join('generated', 'last')
 
 
+def merge(args):
+    import scanresults
+
+    if not check_project_folder():
+        return
+
+    base_path = get_base_path(args)
+    order_path = os.path.join(base_path, 'order.json')
+
+    if not os.path.exists(order_path):
+        error("No order.json file found in `{0}`. Nothing to merge into.".format(base_path))
+        return
+
+    if os.path.exists(os.path.join(base_path, 'results.json')):
+        error("This version has already been scanned.\nRefusing to merge into it.")
+        return
+
+    seed = read_seed(base_path)
+    options = read_options(base_path)
+    test_id = int(os.path.basename(os.path.realpath(base_path))[1:])
+    shard_tests = []
+
+    for shard in args.shards:
+        if not os.path.exists(os.path.join(shard, 'order.json')):
+            error("No order.json file found in `{0}`.".format(shard))
+            return
+
+        if read_seed(shard) != seed:
+            error("`{0}` was generated with a different seed.\nAll the shards of a version must use the same seed.".format(shard))
+            return
+
+        shard_options = read_options(shard)
+
+        if options is not None and shard_options is not None and shard_options != options:
+            error("`{0}` was generated with different options.\nAll the shards of a version must use the same ones.".format(shard))
+            return
+
+        tests = scanresults.parse(os.path.join(shard, 'order.json'))
+        versions = sorted(set(t.exam_id for t in tests.values()) - set([test_id]))
+
+        if versions:
+            error("`{0}` has tests of version {1}, not {2}.\n"
+                  "All the shards must be generated with `--version {2}`.".format(shard, versions[0], test_id))
+            return
+
+        shard_tests.append(tests)
+
+    for shard, tests in zip(args.shards, shard_tests):
+        for d in ['pdf', 'src', 'log', 'images']:
+            if not os.path.exists(os.path.join(shard, d)):
+                continue
+
+            if not os.path.exists(os.path.join(base_path, d)):
+                os.mkdir(os.path.join(base_path, d))
+
+            for f in os.listdir(os.path.join(shard, d)):
+                shutil.copy(os.path.join(shard, d, f), os.path.join(base_path, d, f))
+
+        scanresults.dump(tests, order_path)
+        print("Merged {0} tests from `{1}`".format(len(tests), shard))
+
+
 def grade(args):
     if not check_project_folder():
         return
@@ -579,6 +1087,7 @@ def main():
     gen_parser.add_argument('--answer-template', help="Template for the answers sheets.", default="templates/answer_template.tex")
     gen_parser.add_argument('--master-template', help="Template for the master sheet.", default="templates/master_template.tex")
     gen_parser.add_argument('--text-template', help="Template for the text sheets.", default="templates/text_template.tex")
+    gen_parser.add_argument('--solution-template', help="Template for the grader sheet.", default="templates/solution_template.txt")
     gen_parser.add_argument('--questions-value', help="Default value for each question.", metavar='N', type=float, default=1.)
     gen_parser.add_argument('--dont-shuffle-tags', help="Disallow shuffling of tags.", action='store_true')
     gen_parser.add_argument('--sort-questions', help="After selecting questions, put them in the same order as in the master.", action='store_true')
@@ -587,17 +1096,40 @@ def main():
     gen_parser.add_argument('--election', help="Toggle all options for election mode.", action='store_true')
     gen_parser.add_argument('--questionnaire', help="Toggle all options for questionnaire mode.", action='store_true')
     gen_parser.add_argument('--dont-generate-master', help="Do not generate a master file.", action='store_true')
+    gen_parser.add_argument('-j', '--jobs', metavar='N', type=int, default=None, help="Number of worker processes used to build QR codes and compile LaTeX files. By default, one per CPU.")
+    gen_parser.add_argument('--precompile-preamble', action='store_true', help="Load the preamble shared by the answer and text sheets once into a precompiled LaTeX format, and compile every sheet with it.")
+    gen_parser.add_argument('--vector-qrcodes', action='store_true', help="Draw the QR codes with LaTeX rules instead of PNG files. Needs templates that place them with `qrcode(number)`.")
+    gen_parser.add_argument('--single-document', choices=['split', 'keep'], default=None, help="Put all the answer sheets, and all the text sheets, into a single LaTeX document each and compile it only once. With `split`, the PDF is then split into one PDF per sheet. With `keep`, the single print-ready PDF is kept instead.")
+    gen_parser.add_argument('--no-build-cache', action='store_true', help="With --regenerate, compile every LaTeX file, instead of reusing the PDFs of the files that did not change since the version was last built.")
+    gen_parser.add_argument('-r', '--regenerate', metavar='VERSION', type=int, default=None, help="Generate an existing version again in place, with its own seed unless --seed is given, and the same answers per page and drawing options. Only the files that changed are compiled again.")
+    gen_parser.add_argument('--tests', metavar='LIST', default=None, help="With --regenerate, only generate again the tests in LIST, like `3,7-9`, leaving the rest of the version untouched.")
+    gen_parser.add_argument('--batch', help="Draw all the tests at once with NumPy. Faster for large versions, but gives different tests than the default mode for the same seed.", action='store_true')
+    gen_parser.add_argument('--balanced', action='store_true', help="Draw the least used questions first, so every question appears in about as many tests of the version while meeting the tag restrictions.")
+    gen_parser.add_argument('--max-overlap', metavar='FRACTION', type=float, default=None, help="Keep the overlap of each test with the previous ones under FRACTION, so students seated side by side get different tests. Questions count half and the order of their options the other half. Not available with --batch.")
+    gen_parser.add_argument('--overlap-window', metavar='N', type=int, default=1, help="Number of previous tests each test is kept apart from with --max-overlap. By default 1.")
+    gen_parser.add_argument('--timings', action='store_true', help="Print how long each phase of the generation took. They are always saved to `timings.json` in the version folder.")
+    gen_parser.add_argument('--shard', metavar='K/N', default=None, help="Only generate the K-th of N slices of the tests, to split a version across several machines. Every shard must be given the same --version, --seed and --tests-count, and then joined with `autoexam merge`.")
+    gen_parser.add_argument('--version', metavar='VERSION', type=int, default=None, help="With --shard, the version the shard belongs to. It is created if it does not exist here, and it does not become the last version.")
     gen_parser.set_defaults(func=generate)
 
+    merge_parser = commands.add_parser('merge', help='Merges the shards of a version generated in other machines into this one.')
+    merge_parser.add_argument('shards', metavar='FOLDER', nargs='+', help="The version folders generated by the other shards.")
+    merge_parser.add_argument('-v', '--version', help="Specific version to merge into. If not provided, then the `last` version is used.")
+    merge_parser.set_defaults(func=merge)
+
     scanner_parser = commands.add_parser('scan', help='Runs the exam scanner')
     scanner_parser.add_argument('-o', '--outfile', type=str, default="results.json",
                                 help='the file name to dump the scan results. If the file exists it will append the results.')
     scanner_parser.add_argument('-c', '--cameras', type=int, nargs="+", default=[0],
-                                help='the list of index of the cameras to be used to scan the tests.')
+                                help='the list of index of the cameras to be used to scan the tests. All of them are scanned at the same time.')
     scanner_parser.add_argument('-f', '--folder', type=str, default="",
                                 help='the folder that includes all the images to scann.')
     scanner_parser.add_argument('-t', '--time', type=float, default=0.5,
                                 help='time in seconds it takes to load the next image on the specified folder.')
+    scanner_parser.add_argument('-b', '--batch', action='store_true', default=False,
+                                help='scan every image of --folder once, as fast as possible and without windows, and save the result of each image.')
+    scanner_parser.add_argument('-j', '--jobs', metavar='N', type=int, default=None,
+                                help='number of workers that recognize the images: processes with --batch, threads with the cameras. By default, one per CPU.')
     scanner_parser.add_argument('-a', '--autowrite', action='store_true', default=False,
                                 help='update the scanner results file every time a document is scanned')
     #TODO: PLEASE REMOVE THIS AS SOON AS POSIBLE
@@ -616,7 +1148,9 @@ def main():
     edit_parser.set_defaults(func=edit)
 
     stats_parser = commands.add_parser('stats', help='Compiles a series of statistics for the current project.')
+    stats_parser.add_argument('-m', '--master', help="Path to the master file that contains the test description.", default='master.txt')
     stats_parser.add_argument('-s', '--samples', help='Number of samples to take for simulation-based stats.', default=10000, type=int)
+    stats_parser.add_argument('-b', '--balanced', action='store_true', help='Simulate tests drawn with `gen --balanced`.')
     stats_parser.add_argument('--grades-scale', help='Step of the grading scale to simulate.', default=0.1, type=float)
     stats_parser.set_defaults(func=stats)
 
@@ -6,16 +6,20 @@ import numpy as np
 import sys
 import copy
 import time
+import Queue
+import threading
+import collections
+import multiprocessing
 from scanresults import *
 
 import math
 import re
 
-report = None
+#default parameters, each TestScanner works on its own copy of them
 doc_parameters = {
     "debug": False, #Show images of all the recognition process
     "show_image": True, #if it is a camera it shows a window with the images, and if it is an image it shows the image #not in use
-    "is_camera": False,
+    "headless": False, #never open HighGUI windows, for batch scans and builds of OpenCV without them
     "double_check": True, #Makes a double confirmation before to return a success report
     "marker_image": "latex/marker.png", #Image of the marker to use in the borders
     "answer_cols": 5, ##the number of questions per column, this value is fixed
@@ -73,71 +77,84 @@ doc_parameters = {
 }
 
 class TestScanner:
+    """Scans the tests of `testsfile`. The parameters, the QR code scanner
+    and the marker image belong to each instance, so several scanners can
+    work at the same time, each in its own thread"""
     def __init__(self, w, h, testsfile, **kw):
-        for (k,v) in kw.items():
-            doc_parameters[k]=v
-        doc_parameters["scanner"] = QRScanner(w,h);
-        marker_path = os.path.join(os.environ['AUTOEXAM_FOLDER'], doc_parameters["marker_image"])
-        doc_parameters["loaded_marker"] = cv2.imread(marker_path,0)
-        doc_parameters["init"] = True
-        doc_parameters["tests"] = parse(testsfile)
+        self.parameters = parameters = dict(doc_parameters)
+        parameters.update(kw)
+        #the debug mode shows windows
+        if parameters["headless"]:
+            parameters["debug"] = False
+        parameters["scanner"] = QRScanner(w,h);
+        marker_path = os.path.join(os.environ['AUTOEXAM_FOLDER'], parameters["marker_image"])
+        parameters["loaded_marker"] = cv2.imread(marker_path,0)
+        parameters["init"] = True
+        parameters["tests"] = parse(testsfile)
 
         #---------------------REMOVE ALL THIS---------------------
-        if doc_parameters["poll"]:
-            doc_parameters["up_margin"] = doc_parameters["p_up_margin"]
-            doc_parameters["down_margin"] = doc_parameters["p_down_margin"]
-            doc_parameters["left_margin"] = doc_parameters["p_left_margin"]
-            doc_parameters["right_margin"] = doc_parameters["p_right_margin"]
-
-            doc_parameters["cell_up_margin"] = doc_parameters["p_cell_up_margin"]
-            doc_parameters["cell_down_margin"] = doc_parameters["p_cell_down_margin"]
-            doc_parameters["cell_left_margin"] = doc_parameters["p_cell_left_margin"]
-            doc_parameters["cell_right_margin"] = doc_parameters["p_cell_right_margin"]
-
-            doc_parameters["answer_cols"] = doc_parameters["p_answer_cols"]
+        if parameters["poll"]:
+            parameters["up_margin"] = parameters["p_up_margin"]
+            parameters["down_margin"] = parameters["p_down_margin"]
+            parameters["left_margin"] = parameters["p_left_margin"]
+            parameters["right_margin"] = parameters["p_right_margin"]
+
+            parameters["cell_up_margin"] = parameters["p_cell_up_margin"]
+            parameters["cell_down_margin"] = parameters["p_cell_down_margin"]
+            parameters["cell_left_margin"] = parameters["p_cell_left_margin"]
+            parameters["cell_right_margin"] = parameters["p_cell_right_margin"]
+
+            parameters["answer_cols"] = parameters["p_answer_cols"]
         #---------------------------------------------------------
 
 
     def scan(self, source):
-        return get_scan_report(source)
+        return get_scan_report(source, self.parameters)
+
+    def scan_image(self, frame):
+        """Scans a single image once, without waiting for a second frame"""
+        if not self.parameters["init"]: return Report()
+        return get_image_report(frame, self.parameters)
 
     def finalize(self):
-        doc_parameters["scanner"] = None
-        doc_parameters["loaded_marker"] = None
-        doc_parameters["init"] = False
-        cv2.destroyAllWindows()
+        self.parameters["scanner"] = None
+        self.parameters["loaded_marker"] = None
+        self.parameters["init"] = False
+        if not self.parameters["headless"]:
+            cv2.destroyAllWindows()
 
-def get_scan_report(source):
-    if not doc_parameters["init"]: return Report()
+def get_scan_report(source, parameters):
+    if not parameters["init"]: return Report()
 
-    global report
     # do always a single check if it is not a camera
-    if not doc_parameters["double_check"] or not doc_parameters['is_camera']:
-        report = Report()
+    if not parameters["double_check"] or not source.is_camera:
         frame = source.get_next()
-        return get_image_report(frame)
+        if frame is None: return Report()
+        return get_image_report(frame, parameters)
     #if double check is enabled...
     first = None
     while True:
         if not first:
-            report = Report()
             frame = source.get_next()
-            first = get_image_report(frame)
+            if frame is None: return Report()
+            first = get_image_report(frame, parameters)
         if not first.success:
             return first
         else:
-            report = Report()
             frame = source.get_next()
-            second = get_image_report(frame)
+            if frame is None: return Report()
+            second = get_image_report(frame, parameters)
             if not second.success or second.test==first.test:
                 return second
             else:
                 first = second
                 continue
 
-def get_image_report(frame):
-    scanner = doc_parameters.get("scanner")
-    marker = doc_parameters.get("loaded_marker")
+def get_image_report(frame, parameters):
+    """Scans a frame with the parameters of a scanner -> Report"""
+    report = Report()
+    scanner = parameters.get("scanner")
+    marker = parameters.get("loaded_marker")
     #TODO reject blurred images
     # Set it to gray scale
     gray_image = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
@@ -146,40 +163,40 @@ def get_image_report(frame):
     # Scan for QRcodes
     qrcodes = scanner.get_qrcodes(image)
     # Check qrcode validity
-    qr_is_ok, err_msg = qrcode_ok(qrcodes)
+    qr_is_ok, err_msg = qrcode_ok(qrcodes, parameters)
     if qr_is_ok:
         qrcode = qrcodes.pop()
-        report.test = get_test_from_qrcode(qrcode)
+        report.test = get_test_from_qrcode(qrcode, parameters)
         #paint the qrcode in white to lower the chances of getting wrong matches
         cv2.fillConvexPoly(image,np.int32([list(x) for x in qrcode.location]) ,(255))
-        show_debug_image(image,"QR filled.")
-        size = int(doc_parameters["marker_size"] * dist(qrcode.location[0],qrcode.location[1]));
+        show_debug_image(image,"QR filled.", parameters)
+        size = int(parameters["marker_size"] * dist(qrcode.location[0],qrcode.location[1]));
         rotated, gray_image =  fix_rotation(qrcode.location, image, gray_image)
         #detect_lines(rotated) #Search for lines
-        show_debug_image(rotated,"After rotation.")
-        show_debug_image(gray_image,"Gray after rotation")
+        show_debug_image(rotated,"After rotation.", parameters)
+        show_debug_image(gray_image,"Gray after rotation", parameters)
         small_marker = cv2.resize(marker,(size,size))
-        markers = get_marker_positions(rotated, small_marker, doc_parameters["marker_match_min_quality"])
+        markers = get_marker_positions(rotated, small_marker, parameters["marker_match_min_quality"], parameters)
         if len(markers)==4 and rectangle_sort(markers,rotated):
-            answer_area = perspective_transform(gray_image, markers)
-            show_debug_image(answer_area,"All Answer area cropped.")
-            cols = doc_parameters["answer_cols"]
+            answer_area = perspective_transform(gray_image, markers, parameters)
+            show_debug_image(answer_area,"All Answer area cropped.", parameters)
+            cols = parameters["answer_cols"]
             total_q = len(report.test.questions)
             rows = total_q/cols if total_q%cols==0 else (total_q/cols)+1
 
             #TODO make a parameter out of wish order to scan the tests
-            answer_imgs = get_answer_images(answer_area, cols, rows, len(report.test.questions))
+            answer_imgs = get_answer_images(answer_area, cols, rows, len(report.test.questions), parameters)
             question=0
             bad_data = False
             for img in answer_imgs:
-                correct, selection = get_selections(img, report.test.questions[question], question)
+                correct, selection = get_selections(img, report.test.questions[question], question, report, parameters)
                 if correct:
                     report.test.questions[question].answers = selection
                 else:
                     bad_data = True
                 question+=1
             #TODO debug
-            show_debug_image(answer_area,"Answer area marked.", True)
+            show_debug_image(answer_area,"Answer area marked.", parameters, True)
 
             if not bad_data:
                 report.success = True
@@ -195,7 +212,7 @@ def get_image_report(frame):
 #   exam id | test id | version
 DATA_RE = re.compile(r'''[0-9]+\|[0-9]+\|[0-9]+''',re.UNICODE)
 
-def qrcode_ok(qrcodes):
+def qrcode_ok(qrcodes, parameters):
     if len(qrcodes)!=1:
         return False, QrcodeError()
     data = qrcodes[0].data
@@ -205,15 +222,15 @@ def qrcode_ok(qrcodes):
         test_id = int(data.split('|')[1])
         exam_id = int(data.split('|')[0])
         #has the correct version
-        if doc_parameters["version"]!=version:
+        if parameters["version"]!=version:
             return False, QrcodeError(  err_type=QRCodeErrorTypes.FORMAT,
                                         msg = "The test was created with a different version of this software.")
         #the id is in the tests pool
-        if test_id not in doc_parameters["tests"]:
+        if test_id not in parameters["tests"]:
             return False, QrcodeError(  err_type=QRCodeErrorTypes.FORMAT,
                                         msg = "The metadata of the test is not on the input file.")
         #get the test and check the if is has the correct exam id
-        test = doc_parameters["tests"][test_id]
+        test = parameters["tests"][test_id]
         if test.exam_id != exam_id:
             return False, QrcodeError(  err_type=QRCodeErrorTypes.FORMAT,
                                         msg = "The test is from the exam: %d and the metadata is for the exam: %d"%(exam_id,test.exam_id))
@@ -222,10 +239,10 @@ def qrcode_ok(qrcodes):
         return False, QrcodeError(  err_type=QRCodeErrorTypes.FORMAT,
                                     msg = "The QRCode has a wrong format")
 
-def get_test_from_qrcode(qrcode):
+def get_test_from_qrcode(qrcode, parameters):
     info = qrcode.data.split('|')
     test_id = int(info[1])
-    return copy.deepcopy(doc_parameters["tests"][test_id])
+    return copy.deepcopy(parameters["tests"][test_id])
 
 class QRCode(object):
     """QRCode class"""
@@ -256,9 +273,11 @@ class QRScanner(object):
         return result
 
     def cv2_to_zbar_image(self, cv2_image):
-        return zbar.Image(self.width, self.height, 'Y800',cv2_image.tostring())
+        #use the size of each image, the images of a folder may not all have the same
+        height, width = cv2_image.shape[:2]
+        return zbar.Image(width, height, 'Y800',cv2_image.tostring())
 
-def detect_lines(gray):
+def detect_lines(gray, parameters):
     #edges = cv2.Canny(gray,50,150,apertureSize = 3)
     edges = gray
     lines = cv2.HoughLines(edges,1.0,np.pi/200.0,850)
@@ -275,12 +294,12 @@ def detect_lines(gray):
         y2 = int(y0 - 1000*(a))
         cv2.line(color,(x1,y1),(x2,y2),(0,0,255),2)
 
-    show_debug_image(color,"lines")
+    show_debug_image(color,"lines", parameters)
 
-def fix_rotation_with_perspective(qr_rect, image):
+def fix_rotation_with_perspective(qr_rect, image, parameters):
     """Fixes the rotation of the image using the qrcode rectangle. -> cv2.image"""
-    qrcode_w = doc_parameters["qrcode_width"]
-    margin = doc_parameters["margin"]
+    qrcode_w = parameters["qrcode_width"]
+    margin = parameters["margin"]
     pts1 = np.float32([list(x) for x in qr_rect])
     pts2 = np.float32([[margin,margin],[margin,qrcode_w+margin],[qrcode_w+margin,qrcode_w+margin],[qrcode_w+margin,margin]])
 
@@ -322,13 +341,13 @@ def fix_rotation(qr_rect, image, aux_image):
     w, h = bigger_img.shape[::-1]
     M = cv2.getRotationMatrix2D((w/2,h/2),180*angle/np.pi,1.0)
     #TODO o not use the variable margin here, try to find the real w, h that accounts for the new transformation
-    #margin = doc_parameters["margin"]
+    #margin = parameters["margin"]
     return ( cv2.warpAffine(bigger_img,M,(w,h)), cv2.warpAffine(bigger_aux,M,(w,h)) )
 
-def get_marker_positions(image, marker,threshold):
+def get_marker_positions(image, marker, threshold, parameters):
     """Finds the 4 markers that surround the answer area in the image. -> list of tuples"""
     res = cv2.matchTemplate(image,marker,cv2.TM_CCOEFF_NORMED)
-    if doc_parameters["debug"]: cv2.imshow("Template Matching",res)
+    if parameters["debug"]: cv2.imshow("Template Matching",res)
     loc = np.where( res >= threshold)
     w, h = marker.shape[::-1]
     points = [ (pt[0]+w/2,pt[1]+h/2) for pt in zip(*loc[::-1]) ]
@@ -382,12 +401,12 @@ def rectangle_sort(markers,image):
     markers.extend(result)
     return True
 
-def perspective_transform(image, markers):
+def perspective_transform(image, markers, parameters):
     """Makes the perspective transformation to remove possible deformations of the answer area"""
     pts_area = np.float32([list(x) for x in markers])
     area_w = np.linalg.norm(pts_area[1] - pts_area[2])
     area_h = np.linalg.norm(pts_area[0] - pts_area[1])
-    w_s = doc_parameters["work_size"]
+    w_s = parameters["work_size"]
     if area_w>area_h:
         final_h = w_s
         final_w = int(w_s*area_w/area_h)
@@ -401,15 +420,15 @@ def perspective_transform(image, markers):
     M = cv2.getPerspectiveTransform(pts_area,pts2)
     return cv2.warpPerspective(image,M,(final_w,final_h))
 
-def get_answer_images(image, cols, rows, total):
+def get_answer_images(image, cols, rows, total, parameters):
     """Crops the rectangle between the markers that should contain the answers. -> list of cv2.image"""
     result = []
     w, h = image.shape[::-1]
 
-    u_margin = int(round(doc_parameters["up_margin"]*h))
-    d_margin = int(round(doc_parameters["down_margin"]*h))
-    l_margin = int(round(doc_parameters["left_margin"]*w))
-    r_margin = int(round(doc_parameters["right_margin"]*w))
+    u_margin = int(round(parameters["up_margin"]*h))
+    d_margin = int(round(parameters["down_margin"]*h))
+    l_margin = int(round(parameters["left_margin"]*w))
+    r_margin = int(round(parameters["right_margin"]*w))
 
     # TODO: Remove this huge patch
     if rows == 1:
@@ -419,10 +438,10 @@ def get_answer_images(image, cols, rows, total):
     cell_w = (w-(l_margin+r_margin))/cols
     cell_h = (h-(u_margin+d_margin))/rows
 
-    cell_u_margin = int(doc_parameters["cell_up_margin"]*cell_h)
-    cell_d_margin = int(doc_parameters["cell_down_margin"]*cell_h)
-    cell_l_margin = int(doc_parameters["cell_left_margin"]*cell_w)
-    cell_r_margin = int(doc_parameters["cell_right_margin"]*cell_w)
+    cell_u_margin = int(parameters["cell_up_margin"]*cell_h)
+    cell_d_margin = int(parameters["cell_down_margin"]*cell_h)
+    cell_l_margin = int(parameters["cell_left_margin"]*cell_w)
+    cell_r_margin = int(parameters["cell_right_margin"]*cell_w)
 
     cell_h = int(cell_h)
     cell_w = int(cell_w)
@@ -440,21 +459,21 @@ def get_answer_images(image, cols, rows, total):
 
     return result
 
-def get_selections(image, question, index):
+def get_selections(image, question, index, report, parameters):
     """Finds the answers selected by the student. -> (bool correctness, list of answers)"""
-    success, contours = get_contours(image,question.total_answers,index)
+    success, contours = get_contours(image,question.total_answers,index,report,parameters)
     if not success:
         report.success = False
         return False,[]
 
-    thresh = doc_parameters["selection_threshold"]
-    error = doc_parameters["selection_error"]
+    thresh = parameters["selection_threshold"]
+    error = parameters["selection_error"]
 
     master_answers = []
     local_answers = []
 
     vis = None
-    # if doc_parameters["poll"]:
+    # if parameters["poll"]:
     vis = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
 
     a=0
@@ -472,7 +491,7 @@ def get_selections(image, question, index):
             w = Warning(index + 1, a + 1, WarningTypes.UNCERTANTY, selected=False)
             report.test.warnings.append(w)
         a += 1
-        # if doc_parameters["poll"]: #if visualization
+        # if parameters["poll"]: #if visualization
         center = data["center"]
         radius = data["radius"]
         cv2.ellipse(vis, (int(center[0])+2*int(radius),int(center[1])), (int(radius), int(radius)), 0, 0, 360, color, -1)
@@ -488,25 +507,25 @@ def get_selections(image, question, index):
             report.test.warnings.append(w)
 
     #show the image
-    # if doc_parameters["poll"]:
+    # if parameters["poll"]:
     # cv2.imshow("Result", vis)
 
     return True, master_answers
 
-def get_contours(image, total, question):
+def get_contours(image, total, question, report, parameters):
     #Otsu's thresholding
     #cv2.threshold(image,0,255,cv2.THRESH_BINARY+cv2.THRESH_OTSU,image)
     w, h = image.shape[::-1]
     block_size = w
     if block_size%2==0: block_size+=1
-    cv2.adaptiveThreshold(image, 255, cv2.ADAPTIVE_THRESH_MEAN_C,cv2.THRESH_BINARY_INV,block_size,doc_parameters["adaptative_threshold_size"],image)
+    cv2.adaptiveThreshold(image, 255, cv2.ADAPTIVE_THRESH_MEAN_C,cv2.THRESH_BINARY_INV,block_size,parameters["adaptative_threshold_size"],image)
 
     contours, hierarchy = cv2.findContours(image.copy(),cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_SIMPLE)
     contours.reverse()
     if cv2.__version__=="2.4.3": #a bug in opencv 2.4.3, the fix is to add .astype("int") in the contour element
-      contours = [get_contour_data(c.astype('int'), image) for c in contours]
+      contours = [get_contour_data(c.astype('int'), image, parameters) for c in contours]
     else:
-      contours = [get_contour_data(c, image) for c in contours]
+      contours = [get_contour_data(c, image, parameters) for c in contours]
     contours = [c for c in contours if not c["empty"]]
     for i in range(len(contours)): contours[i]["index"]=i
 
@@ -515,10 +534,10 @@ def get_contours(image, total, question):
 
     #if there are more contours than expected try merge them
     if len(contours)>total:
-        contours = merge_contours_kmeans(contours, total, image)
+        contours = merge_contours_kmeans(contours, total, image, parameters)
 
     if len(contours)>1:
-        if not same_size(contours, image):
+        if not same_size(contours, image, parameters):
             report.errors.append(QuestionError(question,"The circles don't have the same size or are too big"))
         else:
             mean_rad = 0
@@ -527,24 +546,24 @@ def get_contours(image, total, question):
             mean_rad=mean_rad/float(len(contours))
             for c in contours:
                 c["radius"] = mean_rad
-                recalculate_intensity(c,image)
+                recalculate_intensity(c,image,parameters)
 
     if len(contours)!= total:
         report.errors.append(QuestionError(question,"The number of circles do not match"))
-    if not doc_parameters["squares"] and not are_circular(contours):
+    if not parameters["squares"] and not are_circular(contours, parameters):
         report.errors.append(QuestionError(question,"All the circles don't have the correct shape"))
 
     if len(contours)>1:
-        if not same_distance(contours,doc_parameters["distance_threshold"]):
+        if not same_distance(contours,parameters["distance_threshold"]):
             report.errors.append(QuestionError(question,"All the circles are not within the same distance"))
 
-        if not are_aligned(contours, doc_parameters["circle_aligment_percent"]):
+        if not are_aligned(contours, parameters["circle_aligment_percent"]):
             report.errors.append(QuestionError(question,"All the boxes are not aligned"))
 
-    if doc_parameters["debug"]:
-        debug_contour_detection(contours, image)
+    if parameters["debug"]:
+        debug_contour_detection(contours, image, parameters)
 
-    if doc_parameters["debug"]:
+    if parameters["debug"]:
         errors = [e for e in report.errors if e.question == question]
         if len(errors)==0: print "-----OK-----"
         else:
@@ -556,7 +575,7 @@ def get_contours(image, total, question):
     if len(report.errors)>0: return False,[]
     return True, contours
 
-def merge_contours_kmeans(contours, centroids, image):
+def merge_contours_kmeans(contours, centroids, image, parameters):
     points = np.float32([p["center"] for p in contours])
     # define criteria and apply kmeans()
     criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 1.0)
@@ -565,7 +584,7 @@ def merge_contours_kmeans(contours, centroids, image):
     for c in xrange(len(points)):
         label = int(labels[c])
         if label in groups:
-            groups[label] = get_contour_data(merge_contours(groups[label], contours[c]),image)
+            groups[label] = get_contour_data(merge_contours(groups[label], contours[c]),image,parameters)
         else:
             groups[label] = contours[c]
 
@@ -578,7 +597,7 @@ def merge_contours_kmeans(contours, centroids, image):
 
     return merged
 
-def try_merge_nearby_contours(contours,image):
+def try_merge_nearby_contours(contours, image, parameters):
     for c1 in contours:
         for c2 in contours:
             if c1["index"]==c2["index"]: continue
@@ -587,8 +606,8 @@ def try_merge_nearby_contours(contours,image):
             if c1["size"]<c2["size"]:
                 big = c2
                 small = c1
-            if dist(big["center"],small["center"])<big["size"]*doc_parameters["merge_size_factor"]:
-                contours[big["index"]] = get_contour_data(merge_contours(big,small),image)
+            if dist(big["center"],small["center"])<big["size"]*parameters["merge_size_factor"]:
+                contours[big["index"]] = get_contour_data(merge_contours(big,small),image,parameters)
                 contours.pop(small["index"])
                 return 1
     return 0
@@ -600,7 +619,7 @@ def merge_contours(big,small):
             result.append(p)
     return np.array([[p] for p in result],dtype=np.int32)
 
-def same_size(contours, image):
+def same_size(contours, image, parameters):
     sizes = [c["radius"]*2 for c in contours]
     sizes.sort()
     median_size = sizes[len(sizes)/2]
@@ -609,7 +628,7 @@ def same_size(contours, image):
     for size in sizes:
         if size >= max_size:
             return False
-        if abs(size/float(median_size) - 1.0) > doc_parameters["circle_size_difference"]:
+        if abs(size/float(median_size) - 1.0) > parameters["circle_size_difference"]:
             return False
     return True
 
@@ -651,20 +670,20 @@ def same_distance(contours, threshold):
 
     return True
 
-def are_circular(contours):
+def are_circular(contours, parameters):
     for c in contours:
         x,y,w,h = c["rect"]
         ratio = float(w)/float(h)
-        if abs(1-ratio) > doc_parameters["circle_ratio_threshold"]:
+        if abs(1-ratio) > parameters["circle_ratio_threshold"]:
             return False
     return True
 
 
-def debug_contour_detection(contours, image):
+def debug_contour_detection(contours, image, parameters):
     vis = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
 
     for contour in contours:
-        new_radius = int((1-doc_parameters["selection_circle_padding"])*contour["radius"])
+        new_radius = int((1-parameters["selection_circle_padding"])*contour["radius"])
 
         print 'vis: ', vis
         print 'int(contour["center"][0]) ', int(contour["center"][0])
@@ -676,18 +695,18 @@ def debug_contour_detection(contours, image):
 
     cv2.imshow("Selection Area", vis)
 
-def recalculate_intensity(contour, image):
-    if not doc_parameters["squares"]:
+def recalculate_intensity(contour, image, parameters):
+    if not parameters["squares"]:
         radius = contour["radius"]
         center = contour["center"]
-        new_radius = int((1-doc_parameters["selection_circle_padding"])*radius)
+        new_radius = int((1-parameters["selection_circle_padding"])*radius)
         mask = np.zeros(image.shape,np.uint8)
         cv2.ellipse(mask, (int(center[0]),int(center[1])), (new_radius, new_radius), 0, 0, 360, 255, -1)
         contour["mean_intensity"] = cv2.mean(image,mask = mask)[0]
 
     else:
         x,y,w,h = contour["rect"]
-        b = doc_parameters["selection_box_padding"]/2.0
+        b = parameters["selection_box_padding"]/2.0
         fillarea = np.array([ [[x+b*w,y+b*h]] , [[x+b*w,y+h-b*h]] , [[x+w-b*w,y+h-b*h]] , [[x+w-b*w,y+b*h]] ], dtype=np.int32 )
         mask = np.zeros(image.shape,np.uint8)
         cv2.drawContours(mask,[fillarea],0,255,-1)
@@ -695,7 +714,7 @@ def recalculate_intensity(contour, image):
         contour["mean_intensity"] = cv2.mean(image,mask = mask)[0]
 
 
-def get_contour_data(contour, image):
+def get_contour_data(contour, image, parameters):
     data = {}
     data["empty"] = cv2.contourArea(contour)<=3
     data["convex"] = cv2.isContourConvex(contour)
@@ -707,25 +726,25 @@ def get_contour_data(contour, image):
     M = cv2.moments(np.array([[p] for p in data["points"]],dtype=np.int32))
     data["center"] = (M['m10']/(M['m00']+0.00001), M['m01']/(M['m00']+0.00001))
     #if the contours are circles instead of squares
-    if not doc_parameters["squares"]:
+    if not parameters["squares"]:
         center, radius = cv2.minEnclosingCircle(contour)
         data["center"] = (int(center[0]),int(center[1]))
         data["radius"] = int(radius)
-        new_radius = int((1-doc_parameters["selection_circle_padding"])*radius)
+        new_radius = int((1-parameters["selection_circle_padding"])*radius)
 
         mask = np.zeros(image.shape,np.uint8)
         cv2.ellipse(mask, (int(center[0]),int(center[1])), (new_radius, new_radius), 0, 0, 360, 255, -1)
         data["mean_intensity"] = cv2.mean(image,mask = mask)[0]
 
     else:
-        b = doc_parameters["selection_box_padding"]/2.0
+        b = parameters["selection_box_padding"]/2.0
         fillarea = np.array([ [[x+b*w,y+b*h]] , [[x+b*w,y+h-b*h]] , [[x+w-b*w,y+h-b*h]] , [[x+w-b*w,y+b*h]] ], dtype=np.int32 )
         mask = np.zeros(image.shape,np.uint8)
         cv2.drawContours(mask,[fillarea],0,255,-1)
         #improve the calculation of the intensity that decides if it is selected or not.
         data["mean_intensity"] = cv2.mean(image,mask = mask)[0]
 
-    # if doc_parameters["debug"]: print data["mean_intensity"]
+    # if parameters["debug"]: print data["mean_intensity"]
 
 
     return data
@@ -733,24 +752,137 @@ def get_contour_data(contour, image):
 def dist(x,y):
     return math.sqrt( (x[0] - y[0])**2 + (x[1] - y[1])**2 )
 
-def show_debug_image(img, window_name, check_debug=True):
-    if not check_debug or doc_parameters["debug"]:
+def show_debug_image(img, window_name, parameters, check_debug=True):
+    if parameters["headless"]: return
+    if not check_debug or parameters["debug"]:
         cv2.imshow(window_name,img.copy())
 
 def nothing(x):pass
 
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp', '.pbm', '.pgm', '.ppm']
+
+def list_images(path):
+    """The image files in the folder, sorted by name -> list of paths"""
+    return sorted(os.path.join(path, f) for f in os.listdir(path)
+                  if os.path.splitext(f)[1].lower() in IMAGE_EXTENSIONS)
+
+#the scanner of each worker process, with its own marker image and QRScanner
+worker_scanner = None
+
+def init_worker(testsfile, kw):
+    global worker_scanner
+    worker_scanner = TestScanner(0, 0, testsfile, **kw)
+
+def scan_file(filename):
+    """Scans an image file with the scanner of the process -> (path, report),
+    with None as the report if the image could not be read"""
+    frame = cv2.imread(filename, 1)
+    if frame is None:
+        return filename, None
+    return filename, worker_scanner.scan_image(frame)
+
+def scan_folder(path, testsfile, jobs=None, **kw):
+    """Scans every image in the folder once, as fast as they can be read,
+    without windows nor waiting between images, spread over `jobs` worker
+    processes (one per CPU by default). -> yields (path, report) in the
+    order of the file names, whatever order the workers finish in"""
+    files = list_images(path)
+    kw["headless"] = True
+    kw["double_check"] = False
+    workers = min(jobs or multiprocessing.cpu_count(), len(files))
+
+    if workers <= 1:
+        init_worker(testsfile, kw)
+        try:
+            for filename in files:
+                yield scan_file(filename)
+        finally:
+            worker_scanner.finalize()
+        return
+
+    chunksize = max(1, len(files) // (4 * workers))
+    pool = multiprocessing.Pool(workers, init_worker, (testsfile, kw))
+    try:
+        for result in pool.imap(scan_file, files, chunksize):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+class CameraCapture(object):
+    """Reads the frames of a camera in its own thread, keeping only the
+    newest `size` of them, so the scanners never get a stale frame. It can
+    be scanned as a source on its own"""
+    is_camera = True
+
+    def __init__(self, camera, size=2):
+        self.capture = cv2.VideoCapture(camera)
+        self.capture.set(3,800)
+        self.capture.set(4,600)
+        self.width = int(self.capture.get(3))
+        self.height = int(self.capture.get(4))
+
+        self.frames = collections.deque(maxlen=size)
+        self.count = 0 #frames read
+        self.taken = 0 #frames read when the last one was taken
+        self.running = True
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            ok, frame = self.capture.read()
+            if not ok:
+                time.sleep(0.01)
+                continue
+            with self.condition:
+                self.frames.append(frame)
+                self.count += 1
+                self.condition.notify_all()
+
+    def newest(self):
+        """The newest frame, None if none was read yet"""
+        with self.condition:
+            return self.frames[-1] if self.frames else None
+
+    def take(self, timeout=1.0):
+        """The newest frame that was not taken yet, waiting up to `timeout`
+        seconds for it. If no new frame arrives it returns None, so a
+        stalled camera never gives the same frame twice"""
+        with self.condition:
+            end = time.time() + timeout
+            while self.count == self.taken and self.running:
+                left = end - time.time()
+                if left <= 0: return None
+                self.condition.wait(left)
+            if self.count == self.taken: return None
+            self.taken = self.count
+            return self.frames[-1]
+
+    def get_next(self):
+        return self.take()
+
+    def release(self):
+        self.running = False
+        with self.condition:
+            self.condition.notify_all()
+        self.thread.join()
+        self.capture.release()
+
 class ImageSource(object):
     """Wrapper class to abstract the fact that the camera feed may come from a single image"""
     def __init__(self, source, time=3):
         self.time = time
         self.is_camera = type(source)==list
-        doc_parameters['is_camera'] = self.is_camera
+        self.lock = threading.Lock()
         if self.is_camera:
             print "Loading cameras "+str(source)
-            self.sources = [cv2.VideoCapture(cam) for cam in source]
-            for s in self.sources:
-                s.set(3,800)
-                s.set(4,600)
+            self.sources = [CameraCapture(cam) for cam in source]
         else:
             self.sources = self.load_file_list(source)
 
@@ -767,21 +899,31 @@ class ImageSource(object):
 
     def get_size(self):
         if self.is_camera:
-            return (int(self.current_source.get(3)),int(self.current_source.get(4)))
+            return (self.current_source.width,self.current_source.height)
         else:
             return (self.current_source.shape[1],self.current_source.shape[0])
             #return (self.width, self.height)
 
     def get_next(self):
-        if time.time() - self.start_time > self.time:
+        """The next frame to scan. The cameras can be read from several
+        threads at once, each frame goes to a single one of them"""
+        with self.lock:
+            if time.time() - self.start_time > self.time:
                 self.update_current()
+            source = self.current_source
         if self.is_camera:
-            img = self.current_source.read()[1]
-            cv2.imshow("Camera "+str(self.current_index),cv2.flip(img, 1))
-            return img
+            return source.take()
         else:
             # img = self.current_source.copy()
-            return self.current_source
+            return source
+
+    def show(self):
+        """Shows the newest frame of every camera, from the main thread"""
+        if self.is_camera:
+            for i, camera in enumerate(self.sources):
+                img = camera.newest()
+                if img is not None:
+                    cv2.imshow("Camera "+str(i),cv2.flip(img, 1))
 
     def update_current(self):
         self.current_index += 1
@@ -800,3 +942,49 @@ class ImageSource(object):
         if self.is_camera:
             for s in self.sources:
                 s.release()
+
+class ScanWorkers(object):
+    """Scans all the cameras at the same time: `jobs` threads are spread
+    over them, each with its own TestScanner, while the main thread shows
+    the cameras. OpenCV releases the GIL in its heavy calls, so the
+    threads recognize in parallel"""
+    def __init__(self, cameras, jobs, testsfile, **kw):
+        self.reports = Queue.Queue()
+        self.running = True
+        per_camera = max(1, (jobs or multiprocessing.cpu_count()) // len(cameras))
+        self.scanners = []
+        self.threads = []
+        for camera in cameras:
+            for _ in range(per_camera):
+                scanner = TestScanner(camera.width, camera.height, testsfile, **kw)
+                self.scanners.append(scanner)
+                self.threads.append(threading.Thread(target=self.work, args=(scanner, camera)))
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def work(self, scanner, camera):
+        while self.running:
+            try:
+                report = scanner.scan(camera)
+            except Exception as e:
+                #a bad frame must not stop the scanning of its camera
+                report = Report()
+                report.errors.append(ScanError(e))
+            self.reports.put(report)
+
+    def ready(self):
+        """The reports finished since the last call -> list of Report"""
+        result = []
+        while True:
+            try:
+                result.append(self.reports.get_nowait())
+            except Queue.Empty:
+                return result
+
+    def stop(self):
+        self.running = False
+        for t in self.threads:
+            t.join()
+        for scanner in self.scanners:
+            scanner.finalize()
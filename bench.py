@@ -0,0 +1,212 @@
+#! /usr/bin/python
+#-*-coding: utf8-*-
+
+"""
+Benchmarks for the test generator.
+
+Synthesizes masters of several sizes in the format of
+`example-master.txt`, and times each step of `autoexam gen` that runs in
+Python on them: parsing the master, drawing the tests, shuffling and
+converting their questions, rendering the LaTeX templates and dumping
+`order.json`.
+
+Each benchmark runs several times and keeps the best time. With
+--baseline, the results are compared against those stored in that file,
+and the benchmarks that got slower by more than --threshold are reported
+as regressions. Use --save to store the results as the new baseline.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import contextlib
+
+import gen
+import scanresults
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BENCHMARKS = ['parse', 'generate_quiz', 'shuffle', 'convert', 'render', 'dump']
+
+
+def synthesize(questions, tags=20, options=5, restrictions=5, total=20, seed=0):
+    """Returns the text of a master with `questions` questions, spread over
+    `tags` tags, each with `options` options, and with `@tag` minimums for
+    the first `restrictions` tags. Some lines carry comments, escaped
+    `\\%` signs and pinned options, like real masters do."""
+    rng = random.Random(seed)
+    names = ['@tag%i' % t for t in range(tags)]
+    lines = ['%% Synthetic master with %i questions' % questions, '',
+             'total: %i    %% questions per test' % total]
+
+    for name in names[:restrictions]:
+        lines.append('%s: %i' % (name, max(1, total // (2 * restrictions))))
+
+    lines += ['', '----------', '']
+
+    for q in range(1, questions + 1):
+        lines.append('(%i)' % q)
+        lines.append(' '.join(rng.sample(names, rng.choice([1, 1, 2]))))
+        lines.append('This is the text of question %i, with %i\\%% of '
+                     'its words made up.' % (q, rng.randint(0, 100)))
+        lines.append('% A comment inside the question.')
+        lines.append('It can span several lines, like $x^{%i}$.' % q)
+        right = rng.randrange(options)
+
+        for o in range(options):
+            prefix = '_x' if o == right else '_'
+            if o == options - 1 and q % 10 == 0:
+                prefix += '*'
+            lines.append('%s Option %i of question %i.' % (prefix, o, q))
+
+        lines.append('')
+
+    return '\n'.join(lines) + '\n'
+
+
+@contextlib.contextmanager
+def quiet():
+    # scanresults.dump prints a line for every test.
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def best(function, repeat):
+    times = []
+
+    for _ in range(repeat):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+
+    return min(times)
+
+
+def run(scale, args):
+    """Runs every benchmark on a master with `scale` questions. Returns
+    the best time of each one, in seconds."""
+    folder = tempfile.mkdtemp(prefix='autoexam-bench-')
+    master = os.path.join(folder, 'master.txt')
+
+    with open(master, 'w') as fp:
+        fp.write(synthesize(scale, args.tags, args.options, args.restrictions,
+                            args.total))
+
+    bank = gen.parser(master, use_cache=False)
+    gen.check_restrictions(bank)
+    index = gen.TagIndex(bank)
+    rng = random.Random(0)
+    tests = [gen.generate_quiz(bank, rng=rng, index=index) for _ in range(args.tests)]
+    questions = [q for test in tests for q in test]
+    records = dict((i, scanresults.Test(1, i, [q.convert() for q in test]))
+                   for i, test in enumerate(tests))
+
+    text_template = gen.load_template('latex/text_template.tex', ROOT)
+    answer_template = gen.load_template('latex/answer_template.tex', ROOT)
+
+    def qrcode(number, width='2cm'):
+        return ''
+
+    def render():
+        for i, test in enumerate(tests):
+            text_template.render(test=test, number=i, header='', qrcode=qrcode)
+            answer_template.render(answers=[dict(test=list(enumerate(test)), number=i, seed=0,
+                                                 max=max(len(q.options) for q in test))],
+                                   qrcode=qrcode)
+
+    def dump():
+        with quiet():
+            scanresults.dump(records, os.path.join(folder, 'order.json'), overwrite=True)
+
+    benchmarks = {
+        'parse': lambda: gen.parser(master, use_cache=False),
+        'generate_quiz': lambda: [gen.generate_quiz(bank, rng=rng, index=index)
+                                  for _ in range(args.tests)],
+        'shuffle': lambda: [q.shuffle(rng) for q in questions],
+        'convert': lambda: [q.convert() for q in questions],
+        'render': render,
+        'dump': dump,
+    }
+
+    results = {}
+
+    try:
+        for name in BENCHMARKS:
+            results[name] = best(benchmarks[name], args.repeat)
+    finally:
+        for f in os.listdir(folder):
+            os.remove(os.path.join(folder, f))
+        os.rmdir(folder)
+
+    return results
+
+
+def main():
+    args_parser = argparse.ArgumentParser(description="Benchmarks the test generator on synthetic masters.")
+    args_parser.add_argument('-s', '--scales', default='1000,10000,100000', help="Comma separated numbers of questions of the masters to benchmark.")
+    args_parser.add_argument('-n', '--tests', metavar='N', type=int, default=200, help="Number of tests drawn, shuffled, converted, rendered and dumped at each scale.")
+    args_parser.add_argument('--tags', metavar='N', type=int, default=20, help="Number of tags in the masters.")
+    args_parser.add_argument('--options', metavar='N', type=int, default=5, help="Number of options of each question.")
+    args_parser.add_argument('--restrictions', metavar='N', type=int, default=5, help="Number of tags with a minimum number of questions.")
+    args_parser.add_argument('--total', metavar='N', type=int, default=20, help="Number of questions of each test.")
+    args_parser.add_argument('-r', '--repeat', metavar='N', type=int, default=3, help="Times each benchmark runs. The best time is kept.")
+    args_parser.add_argument('-b', '--baseline', metavar='PATH', default='bench-baseline.json', help="File with the times to compare against.")
+    args_parser.add_argument('--save', action='store_true', help="Store the results in the baseline file.")
+    args_parser.add_argument('--threshold', type=float, default=0.2, help="Slowdown over the baseline reported as a regression. By default 0.2, that is 20%%.")
+
+    args = args_parser.parse_args()
+
+    baseline = {}
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+
+    results = {}
+    regressions = []
+
+    print('{0:<15} {1:>8} {2:>10} {3:>10} {4:>8}'.format('benchmark', 'scale', 'time', 'baseline', 'change'))
+
+    for scale in [int(s) for s in args.scales.split(',')]:
+        times = run(scale, args)
+
+        for name in BENCHMARKS:
+            key = '%s@%i' % (name, scale)
+            seconds = results[key] = times[name]
+            line = '{0:<15} {1:>8} {2:>9.4f}s'.format(name, scale, seconds)
+
+            if key in baseline:
+                change = seconds / baseline[key] - 1 if baseline[key] else 0
+                line += ' {0:>9.4f}s {1:>+7.1%}'.format(baseline[key], change)
+
+                if change > args.threshold:
+                    regressions.append(key)
+                    line += '  REGRESSION'
+
+            print(line)
+            sys.stdout.flush()
+
+    if args.save:
+        baseline.update(results)
+
+        with open(args.baseline, 'w') as fp:
+            json.dump(baseline, fp, indent=4, sort_keys=True)
+
+        print('Saved the results to %s' % args.baseline)
+
+    if regressions:
+        print('%i benchmarks regressed: %s' % (len(regressions), ', '.join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
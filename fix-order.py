@@ -17,8 +17,8 @@ def main():
 
 
 def fix(args):
-	gen.parser(args)
-	questions = gen.questions_by_id
+	bank = gen.parser(args.master)
+	questions = bank.questions_by_id
 
 	with open(args.order) as fp:
 		order = json.load(fp)
@@ -2,7 +2,11 @@
 #-*-coding: utf8-*-
 
 import os.path
+import re
 import collections
+import array
+import itertools
+import multiprocessing
 import jinja2
 import random
 import qrcode
@@ -10,253 +14,336 @@ import os
 import sys
 import pprint
 import json
+import hashlib
+import cPickle as pickle
+import time
+import tempfile
 import scanresults
+import timings
 import argparse
 
 
-database = collections.defaultdict(lambda: [])
-questions_by_id = {}
-restrictions = {}
-restrictions_order = {}
-test_id = 1
 debug = sys.argv.count('-d')
-count = 0
+environments = {}
 
 VERSION = 1
 
+# Bump this whenever the layout of the compiled bank changes, so stale
+# caches written by older versions are ignored and rebuilt.
+BANK_FORMAT = 3
 
-def preprocess_line(line, remove_comments=True):
-    if debug > 1:
-        print(u'Reading line: "%s"' % line.decode('utf8'))
 
-    line = line.strip().decode('utf8')
-    if remove_comments and '%' in line:
-        idx = line.index('%')
-        if idx >= 0 and (idx == 0 or line[idx-1] != '\\'):
-            line = line[:idx].strip()
+# What `str.strip` removes, so that decoded lines are stripped exactly
+# like the bytes they come from.
+WHITESPACE = ' \t\n\r\x0b\x0c'
+
+Token = collections.namedtuple('Token', 'kind line value')
 
-    if debug > 1:
-        print(u'Returning line: "%s"' % line)
+
+def remove_comment(line):
+    """Cuts `line` at its first `%`, unless it is escaped as `\\%`."""
+    idx = line.find('%')
+
+    if idx >= 0 and (idx == 0 or line[idx-1] != '\\'):
+        line = line[:idx].strip()
 
     return line
 
 
-def parser(master_path):
-    """
-    Lee el archivo master y se parsea cada una de las preguntas.
-    """
-    master = open(master_path)
-    lines = master.readlines()
-    master.close()
-
-    # Parse the header
-    i = 0
-    while i < len(lines):
-        l = preprocess_line(lines[i][:-1])
-        i += 1
-        if l:
-            if l.startswith('-'):
-                break
-            tag, value = l.split(':')
-            tag = tag.strip()
-            value = int(value.strip())
-            restrictions[tag] = value
-            restrictions_order[tag] = len(restrictions_order)
+def parse_answer(lines, line):
+    """Builds an answer out of its `lines`, the first of which starts with
+    its `_` prefix, dropping the blank and comment lines at its end."""
+    while lines:
+        last = lines[-1].strip()
 
-            if debug:
-                print('Adding restriction: %s: %i' % (tag, value))
+        if last and not last.startswith('%'):
+            break
 
-    if not 'total' in restrictions:
-        raise ValueError('Missing `total` directive')
+        lines.pop()
+
+    answer = u'\n'.join(lines)
+    prefix = answer[:3].lower()
+
+    if prefix.startswith('_*'):
+        answer = (False, True, answer[2:].strip())
+    elif prefix.startswith('_x*'):
+        answer = (True, True, answer[3:].strip())
+    elif prefix.startswith('_x'):
+        answer = (True, False, answer[2:].strip())
+    elif prefix.startswith('_'):
+        answer = (False, False, answer[1:].strip())
+    else:
+        raise ValueError(u'Invalid answer prefix in "%s" at line %i' %
+                        (answer, line))
 
     if debug:
-        print('Restrictions:')
-        pprint.pprint(restrictions)
+        print(u'Found answer:\n%s' % str(answer))
 
-    # Parse questions
-    while i < len(lines):
-        i = parse_question(i, lines)
+    return answer
 
 
-def parse_question(i, lines):
-    """Crea el objeto pregunta y la agrega en los contenidos
-    que se evalúan en la misma."""
+def tokenize(text):
+    """Reads the master in `text` in a single pass, one line at a time.
 
-    global count
+    Yields a `Token` for each restriction of the header, with its tag and
+    value, one for the line of dashes that ends the header, and one for
+    each question, with its header, answers and tags. Each token carries
+    the number of the line it starts at, counted from 1."""
+    lines = text.split(u'\n')
 
-    # Find the id line
-    i, identifier = parse_id(i, lines)
-    i, tags = parse_tag(i, lines)
-    i, header = parse_header(i, lines)
-    i, answers = parse_answers(i, lines)
+    if lines[-1] == u'':
+        lines.pop()
 
-    count += 1
-    question = Question(header, answers, count, tags)
+    state = 'restriction'
+    pending = False
 
-    # Add answers to given tags
-    for t in tags:
-        database[t].append(question)
+    # The question being read, filled in as its lines come.
+    start, tags, header, answers, answer = None, [], [], [], []
 
-    questions_by_id[count] = question
+    for number, line in enumerate(lines, 1):
+        line = line.strip(WHITESPACE)
 
-    return i
+        if state == 'answer':
+            if line and line[0] == '(':
+                answers.append(parse_answer(answer, number - 1))
+                yield Token('question', start, (u'\n'.join(header).strip(), answers, tags))
+                state, pending = 'id', False
+            elif line and line[0] == '_':
+                answers.append(parse_answer(answer, number - 1))
+                answer = [line]
+                continue
+            else:
+                answer.append(line)
+                continue
 
+        if state == 'text':
+            if line and line[0] == '_':
+                if not u'\n'.join(header).strip():
+                    raise ValueError('Header not found at line %i' % number)
 
-def parse_header(i, lines):
-    header = u""
+                state, answers, answer = 'answer', [], [line]
+            else:
+                header.append(line)
 
-    while i < len(lines):
-        l = preprocess_line(lines[i][:-1], remove_comments=False)
-        if l and l[0] == '_':
-            break
-        header += l + '\n'
-        i += 1
+            continue
 
-    header = header.strip()
+        line = remove_comment(line)
 
-    if not header:
-        raise ValueError('Header not found at line %i' % i)
+        if state == 'id':
+            pending = True
 
-    if debug:
-        print(u'Found header: \n%s' % header)
+        if not line:
+            continue
 
-    return i, header
+        if state == 'restriction':
+            if line.startswith('-'):
+                state = 'id'
+                yield Token('separator', number, None)
+                continue
 
+            try:
+                tag, value = line.split(':')
+                value = int(value.strip())
+            except ValueError:
+                raise ValueError(u'Invalid restriction "%s" at line %i' % (line, number))
 
-def strip(line):
-    lines = list(reversed(line.split('\n')))
-    i = 0
+            yield Token('restriction', number, (tag.strip(), value))
+        elif state == 'id':
+            if line[0] != '(' or line[-1] != ')':
+                raise ValueError(u'Not valid Id line: %s at line %i' % (line, number))
 
-    while i < len(lines):
-        l = lines[i].strip()
-        if l and not l.startswith('%'):
-            break
-        i += 1
+            if debug:
+                print(u'Found identifier: %s' % line[1:-1])
 
-    if i >= len(lines):
-        return None
+            state, start = 'tag', number
+        elif state == 'tag':
+            tags = line.split()
 
-    return u'\n'.join(reversed(lines[i:]))
+            for t in tags:
+                if t[0] != '@':
+                    raise ValueError(u'Invalid tag %s at line %i' % (t, number))
 
+            state, header = 'text', []
 
-def parse_answer(i, lines):
-    answer = u""
+    number = len(lines)
 
-    while i < len(lines):
-        l = preprocess_line(lines[i][:-1], remove_comments=False)
-        if l and ((answer and l[0] == '_') or l[0] == '('):
-            break
-        answer += l + '\n'
-        i += 1
+    if state == 'id' and pending:
+        raise ValueError('Id line not found at line %i' % number)
+    elif state == 'tag':
+        raise ValueError('Tag line not found at line %i' % number)
+    elif state == 'text':
+        if not u'\n'.join(header).strip():
+            raise ValueError('Header not found at line %i' % number)
 
-    if not answer:
-        return i, None
+        raise ValueError('No answer found at line %i' % number)
+    elif state == 'answer':
+        answers.append(parse_answer(answer, number))
+        yield Token('question', start, (u'\n'.join(header).strip(), answers, tags))
 
-    answer = strip(answer)
 
-    if answer.lower().startswith('_*'):
-        answer = (False, True, answer[2:].strip())
-    elif answer.lower().startswith('_x*'):
-        answer = (True, True, answer[3:].strip())
-    elif answer.lower().startswith('_x'):
-        answer = (True, False, answer[2:].strip())
-    elif answer.lower().startswith('_'):
-        answer = (False, False, answer[1:].strip())
-    else:
-        raise ValueError(u'Invalid answer prefix in "%s" at line %i' %
-                        (answer, i))
+class QuestionBank(object):
+    """The questions of a master, indexed by tag and by number, together
+    with the tag restrictions of its header.
+
+    A bank holds no global state, so a single process can keep several
+    banks loaded and generate from them independently."""
+
+    def __init__(self):
+        self.database = collections.defaultdict(list)
+        self.questions_by_id = {}
+        self.restrictions = {}
+        self.restrictions_order = {}
+        self.count = 0
+
+    def add_restriction(self, tag, value):
+        self.restrictions[tag] = value
+        self.restrictions_order[tag] = len(self.restrictions_order)
+
+    def add_question(self, header, answers, tags):
+        self.count += 1
+        question = Question(header, answers, self.count, tags)
+
+        # Add answers to given tags
+        for t in tags:
+            self.database[t].append(question)
+
+        self.questions_by_id[self.count] = question
+
+        return question
+
+    @property
+    def questions(self):
+        return [self.questions_by_id[i] for i in sorted(self.questions_by_id)]
+
+
+def parser(master_path, use_cache=True):
+    """
+    Lee el archivo master y se parsea cada una de las preguntas.
+
+    Returns a new `QuestionBank`. The parsed bank is cached in the project
+    folder, keyed on the content hash of the master, so it is only rebuilt
+    when the master changes.
+    """
+    with open(master_path, 'rb') as master:
+        data = master.read()
+
+    digest = hashlib.sha1(data).hexdigest()
+    cache_path = bank_cache_path(master_path)
+
+    if use_cache:
+        bank = load_bank(cache_path, digest)
+
+        if bank is not None:
+            if debug:
+                print('Loaded compiled bank from %s' % cache_path)
+            return bank
+
+    bank = parse_master(data.decode('utf8'))
+
+    if use_cache:
+        save_bank(cache_path, digest, bank)
+
+    return bank
+
+
+def check_header(bank):
+    if not 'total' in bank.restrictions:
+        raise ValueError('Missing `total` directive')
 
     if debug:
-        print(u'Found answer:\n%s' % str(answer))
+        print('Restrictions:')
+        pprint.pprint(bank.restrictions)
 
-    return i, answer
 
+def parse_master(text):
+    """Parses the master in `text`, as unicode, into a new bank."""
+    bank = QuestionBank()
+    checked = False
 
-def parse_answers(i, lines):
-    answers = []
+    for token in tokenize(text):
+        if token.kind == 'restriction':
+            tag, value = token.value
+            bank.add_restriction(tag, value)
 
-    while i < len(lines):
-        i, answer = parse_answer(i, lines)
-        if answer:
-            answers.append(answer)
+            if debug:
+                print('Adding restriction: %s: %i' % (tag, value))
+        elif token.kind == 'separator':
+            check_header(bank)
+            checked = True
         else:
-            break
+            header, answers, tags = token.value
 
-    if not answers:
-        raise ValueError('No answer found at line %i' % i)
+            if debug:
+                print(u'Found question at line %i:\n%s' % (token.line, header))
 
-    return i, answers
+            bank.add_question(header, answers, tags)
 
+    if not checked:
+        check_header(bank)
 
-def parse_tag(i, lines):
-    i, l = skip_blank(i, lines)
+    return bank
 
-    if l is None:
-        raise ValueError('Tag line not found')
 
-    tags = l.split()
+def bank_cache_path(master_path):
+    """Returns the path of the compiled bank for `master_path`, or None
+    if the master is not inside an Autoexam project folder."""
+    folder = os.path.join(os.path.dirname(os.path.abspath(master_path)),
+                          '.autoexam')
 
-    for t in tags:
-        if t[0] != '@':
-            raise ValueError('Invalid tag %s' % t)
-        if debug:
-            print(u'Found tag: %s' % t)
+    if not os.path.isdir(folder):
+        return None
 
-    return i, tags
+    return os.path.join(folder, 'bank')
 
 
-def skip_blank(i, lines):
-    while i < len(lines):
-        l = preprocess_line(lines[i][:-1])
-        if l:
-            return i+1, l
-        i += 1
+def load_bank(cache_path, digest):
+    if cache_path is None or not os.path.exists(cache_path):
+        return None
 
-    return i, None
+    try:
+        with open(cache_path, 'rb') as fp:
+            cached = pickle.load(fp)
+    except Exception:
+        return None
 
+    if cached.get('format') != BANK_FORMAT or cached.get('hash') != digest:
+        return None
 
-def parse_id(i, lines):
-    i, l = skip_blank(i, lines)
+    return cached['bank']
 
-    if l is None:
-        raise ValueError('Id line not found')
 
-    if l[0] != '(' or l[-1] != ')':
-        raise ValueError(u'Not valid Id line: %s at line %i' % (l, i))
+def save_bank(cache_path, digest, bank):
+    if cache_path is None:
+        return
 
-    id_text = l[1:-1]
+    cached = dict(format=BANK_FORMAT, hash=digest, bank=bank)
 
-    if debug:
-        print(u'Found identifier: %s' % id_text)
+    # Write to a temporary file of its own first, so an interrupted run
+    # or another one writing at the same time never leaves a truncated
+    # cache behind.
+    tmp_path = None
 
-    return i, id_text
+    try:
+        fd, tmp_path = tempfile.mkstemp(prefix='bank.', dir=os.path.dirname(cache_path))
 
+        with os.fdopen(fd, 'wb') as fp:
+            pickle.dump(cached, fp, pickle.HIGHEST_PROTOCOL)
 
-class Question:
-    """Las preguntas tienen un campo `header` que es el enunciado,
-    y opciones. Algunas de estas opciones pueden considerarse
-    respuestas correctas."""
+        os.rename(tmp_path, cache_path)
+    except EnvironmentError as e:
+        # The cache only saves time, so the bank is still used.
+        print('Warning: The question bank could not be cached: %s' % e)
 
-    def __init__(self, header, options, number, tags, options_id=None, fixed=None):
-        if (not header or not options):
-            raise ValueError(u'Invalid question %s' % number)
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
-        self.options = options
-        self.header = header
-        self.number = number
-        self.tags = tags
-        self.fixed = fixed or {}
-        self.options_id = options_id
 
-        if self.options_id is None:
-            self.options_id = {}
+class QuestionView(object):
+    """What the templates, the grader and the scanner read from a question
+    as it appears in a test: its `options` in the order of the test, and
+    that `order` as indices into the options of the master."""
 
-            for i, o in enumerate(self.options):
-                if o in self.options_id:
-                    raise Exception('Invalid option exception. Duplicated answers are not allowed')
-                self.options_id[o] = i
-                if o[1]:
-                    self.fixed[o] = i
+    __slots__ = ()
 
     @property
     def correct_answers(self):
@@ -264,61 +351,39 @@ class Question:
 
     @property
     def answers_count(self):
-        return len(self.options)
+        return len(self.order)
 
     def enumerate_options(self):
         return enumerate(self.options)
 
-    def shuffle(self):
-        """
-        Devuelve las opciones desordenadas.
-        """
-        options = list(self.options)
-        random.shuffle(options)
-
-        for o in list(options):
-            if o in self.fixed:
-                pos = self.fixed[o]
-                idx = options.index(o)
-                tmp = options[pos]
-                options[pos] = o
-                options[idx] = tmp
-
-        return Question(self.header, options, self.number, self.tags, self.options_id, self.fixed)
-
     def convert(self):
-        order = [self.options_id[o] for o in self.options]
+        order = list(self.order)
 
-    	if debug:
+        if debug:
             print(order)
 
-        return scanresults.Question(self.number, len(self.options),
+        return scanresults.Question(self.number, len(order),
                                     self.multiple, order=order)
 
-    @property
-    def multiple(self):
-        return len([o for o in self.options if o[0]]) > 1
-
     def options_text(self, i, max):
         alphabet = list("abcdefghijklmnopqrstuvwxyz")
         first = True
 
-        for a, o in zip(alphabet, self.options):
+        for a, o in zip(alphabet, self.order):
             if first:
                 yield i, a
                 first = False
             else:
                 yield "", a
 
-        for i in range(len(self.options), max):
+        for i in range(len(self.order), max):
             yield "", ""
 
     def __str__(self):
         return str(self.number)
 
     def qrcode(self):
-        opts = "(%s)" % ",".join(str(self.options_id[o])
-                                 for o in self.options)
+        opts = "(%s)" % ",".join(str(j) for j in self.order)
         # return str(self.number) + '**'
 
         if self.multiple:
@@ -327,12 +392,140 @@ class Question:
             return "%i%s" % (self.number, opts)
 
 
+class Question(QuestionView):
+    """Las preguntas tienen un campo `header` que es el enunciado,
+    y opciones. Algunas de estas opciones pueden considerarse
+    respuestas correctas.
+
+    A question is shared by every test it appears in, and never changes
+    once parsed. Each test only keeps the permutation of its options, as
+    an `ExamQuestion`."""
+
+    __slots__ = ('header', 'options', 'number', 'tags', 'fixed', 'multiple')
+
+    def __init__(self, header, options, number, tags):
+        if (not header or not options):
+            raise ValueError(u'Invalid question %s' % number)
+
+        if len(set(options)) != len(options):
+            raise Exception('Invalid option exception. Duplicated answers are not allowed')
+
+        self.options = tuple(options)
+        self.header = header
+        self.number = number
+        self.tags = tags
+        self.fixed = frozenset(i for i, o in enumerate(options) if o[1])
+        self.multiple = len([o for o in options if o[0]]) > 1
+
+    @property
+    def order(self):
+        return range(len(self.options))
+
+    def shuffle(self, rng=random):
+        """
+        Devuelve las opciones desordenadas.
+
+        Pinned options are swapped back into their place after the
+        shuffle, which draws exactly what shuffling the options
+        themselves would.
+        """
+        order = range(len(self.options))
+        rng.shuffle(order)
+
+        if self.fixed:
+            where = [0] * len(order)
+
+            for idx, j in enumerate(order):
+                where[j] = idx
+
+            for j in list(order):
+                if j in self.fixed:
+                    idx, other = where[j], order[j]
+                    order[j], order[idx] = j, other
+                    where[j], where[other] = j, idx
+
+        return ExamQuestion(self, order)
+
+
+class ExamQuestion(QuestionView):
+    """A question as it appears in a single test: the shared `Question`
+    and the permutation of its options, as a compact array."""
+
+    __slots__ = ('question', 'order')
+
+    def __init__(self, question, order):
+        self.question = question
+        self.order = array.array('B', order)
+
+    @property
+    def header(self):
+        return self.question.header
+
+    @property
+    def number(self):
+        return self.question.number
+
+    @property
+    def tags(self):
+        return self.question.tags
+
+    @property
+    def multiple(self):
+        return self.question.multiple
+
+    @property
+    def options(self):
+        options = self.question.options
+        return [options[j] for j in self.order]
+
+
+def template_environment(folder='.'):
+    """Returns the Jinja environment for the templates in `folder`,
+    usually a project. Template names are paths relative to it, so
+    templates can extend and include each other.
+
+    Environments are shared within a process, and inside a project the
+    compiled templates are also kept in `.autoexam/jinja`, so a template
+    is only compiled again when it changes."""
+    folder = os.path.abspath(folder)
+
+    if folder not in environments:
+        bytecode_cache = None
+        cache = os.path.join(folder, '.autoexam', 'jinja')
+
+        if os.path.isdir(os.path.dirname(cache)):
+            if not os.path.exists(cache):
+                os.mkdir(cache)
+            bytecode_cache = jinja2.FileSystemBytecodeCache(cache)
+
+        environments[folder] = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(folder),
+            bytecode_cache=bytecode_cache)
+
+    return environments[folder]
+
+
+def load_template(path, folder='.'):
+    """Loads the template at `path`, relative to `folder` or absolute.
+    Templates outside of `folder` are loaded from their own folder."""
+    folder = os.path.join(os.path.abspath(folder), '')
+    path = os.path.abspath(os.path.join(folder, path))
+
+    if path.startswith(folder):
+        name = path[len(folder):]
+    else:
+        folder, name = os.path.split(path)
+
+    return template_environment(folder).get_template(name.replace(os.sep, '/'))
+
+
 def qrcode_data(test_id, i, test):
     return "%i|%i|%i" % (test_id, i, VERSION)
 
 
-def generate_qrcode(i, test):
-    filename = 'generated/v{0}/qrcode-{1}.png'.format(test_id, i)
+def generate_qrcode(test_id, i, test, folder=None):
+    folder = folder or 'generated/v{0}'.format(test_id)
+    filename = os.path.join(folder, 'qrcode-{0}.png'.format(i))
 
     f = open(filename, 'w')
     qr = qrcode.QRCode(box_size=10, border=0)
@@ -350,69 +543,476 @@ def generate_qrcode(i, test):
     f.close()
 
 
-def generate_quiz(args=None):
-    total = restrictions['total']
-    res = dict(restrictions)
-    res.pop('total')
-    base = {}
+# Fewer QR codes than this are built without a pool of processes.
+QRCODE_POOL_MIN = 32
+
+
+def build_qrcode(key):
+    """Builds the QR code of a test in a worker process. Returns its
+    modules if `vector`, otherwise writes its PNG file and returns None,
+    along with the time it took."""
+    test_id, i, vector, folder = key
+    start = time.time()
+
+    if vector:
+        code = qrcode_modules(qrcode_data(test_id, i, None))
+    else:
+        code = generate_qrcode(test_id, i, None, folder)
+
+    return code, time.time() - start
+
+
+def qrcode_modules(data):
+    """Returns the QR code for `data` as rows of booleans, True for the
+    dark modules."""
+    qr = qrcode.QRCode(border=0)
+    qr.add_data(data)
+    qr.make()
+    return qr.modules
+
+
+def qrcode_tex(modules, width):
+    """Draws a QR code as a LaTeX picture `width` wide (e.g. "2cm"), with
+    a single rule for each run of dark modules in a row."""
+    size = len(modules)
+    value, unit = re.match(r'\s*([0-9.]+)\s*([a-z]+)', width).groups()
+    rules = []
+
+    for r, row in enumerate(modules):
+        c = 0
+
+        while c < size:
+            if not row[c]:
+                c += 1
+                continue
+
+            start = c
+
+            while c < size and row[c]:
+                c += 1
+
+            rules.append('\\put(%i,%i){\\rule{%i\\unitlength}{\\unitlength}}' %
+                         (start, size - 1 - r, c - start))
+
+    return ('{\\setlength{\\unitlength}{%.5f%s}\\begin{picture}(%i,%i)%s\\end{picture}}' %
+            (float(value) / size, unit, size, size, ''.join(rules)))
+
+
+def build_qrcodes(test_id, indices, vector, jobs=None, folder=None, timer=timings.NONE):
+    """Builds the QR codes of the tests numbered `indices` in parallel,
+    with `jobs` processes, into `folder`.
+
+    The codes only depend on the version and the number of each test, so
+    they are built while the tests are drawn and written. Returns the
+    pool, which the caller must terminate, and an iterator that yields
+    each test number, in order, as soon as its code is ready, with the
+    modules of the code if `vector`, otherwise with None after writing
+    its PNG file. Only a few codes are built in this process instead,
+    with no pool, as forking takes longer than building them."""
+    keys = [(test_id, i, vector, folder) for i in indices]
+    pool = None
+
+    if len(keys) < QRCODE_POOL_MIN:
+        codes = itertools.imap(build_qrcode, keys)
+    else:
+        workers = min(jobs or multiprocessing.cpu_count(), len(keys))
+        chunksize = max(1, len(keys) // (4 * workers))
+        pool = multiprocessing.Pool(workers)
+        codes = pool.imap(build_qrcode, keys, chunksize)
+
+    def ready():
+        for i, (code, seconds) in itertools.izip(indices, codes):
+            timer.add('qrcode', seconds)
+            yield i, code
+
+    return pool, ready()
+
+
+def tag_demands(bank):
+    """Returns the number of questions each restricted tag asks for."""
+    return dict((tag, value) for tag, value in bank.restrictions.items()
+                if tag != 'total' and value > 0)
+
+
+class IndexSet(object):
+    """A set backed by an array, with O(1) random choice and removal.
+
+    Removing swaps the item with the last one and shrinks the set, and
+    `restore` undoes a removal exactly, so a journal of removals can put
+    the array back in its original order."""
 
-    for k, v in database.items():
-        base[k] = list(v)
+    def __init__(self, items):
+        self.items = list(items)
+        self.position = dict((x, i) for i, x in enumerate(self.items))
+        self.size = len(self.items)
 
-    print('new quiz')
-    print('total', total)
-    print('base', base)
-    print('res', res)
-    print('')
-    test = set()
-    tries = 0
+    def __contains__(self, x):
+        return self.position[x] < self.size
 
-    def get_question(tag):
-        print('tag', tag)
-        print('base', base)
-        if tag not in base:
+    def choice(self, rng):
+        return self.items[rng.randrange(self.size)]
+
+    def remove(self, x):
+        i = self.position[x]
+        self.size -= 1
+        last = self.items[self.size]
+        self.items[i], self.items[self.size] = last, x
+        self.position[last], self.position[x] = i, self.size
+        return i
+
+    def restore(self, x, i):
+        other = self.items[i]
+        self.items[i], self.items[self.size] = x, other
+        self.position[x], self.position[other] = i, self.size
+        self.size += 1
+
+    # For sets that are never restored.
+
+    def add(self, x):
+        self.position[x] = len(self.items)
+        self.items.append(x)
+        self.size += 1
+
+    def discard(self, x):
+        self.remove(x)
+        self.items.pop()
+        del self.position[x]
+
+
+class TagIndex(object):
+    """The questions still free in each tag while drawing a test.
+
+    It is built once per bank and shared by all the tests drawn from it:
+    taking a question removes it from all its tags at once, and `reset`
+    rolls the removals back, so drawing a test costs time proportional to
+    the questions in the test and not to the size of the bank."""
+
+    def __init__(self, bank):
+        self.tags = {}
+        self.free = {}
+
+        for tag in sorted(bank.database):
+            numbers = []
+
+            for q in bank.database[tag]:
+                if tag not in self.tags.setdefault(q.number, []):
+                    numbers.append(q.number)
+                    self.tags[q.number].append(tag)
+
+            self.free[tag] = IndexSet(numbers)
+
+        self.open = IndexSet(t for t in sorted(self.free) if self.free[t].size)
+        self.journal = []
+
+    def take(self, number):
+        for tag in self.tags[number]:
+            free = self.free[tag]
+            self.journal.append((free, number, free.remove(number)))
+
+            if not free.size:
+                self.journal.append((self.open, tag, self.open.remove(tag)))
+
+    def reset(self):
+        while self.journal:
+            s, x, i = self.journal.pop()
+            s.restore(x, i)
+
+
+class Usage(object):
+    """How many tests each question has appeared in, for drawing the least
+    used questions first so that all of them are used about as often.
+
+    The questions of each tag, and all of them under None, are kept in an
+    `IndexSet` per count, so the least used question still free in a tag
+    is found by looking only at its lowest counts."""
+
+    # Random picks tried in a level before looking through all of it.
+    PROBES = 8
+
+    def __init__(self, index):
+        self.tags = index.tags
+        self.count = dict((number, 0) for number in index.tags)
+        self.levels = {}
+        self.low = {}
+
+        for number, tags in index.tags.items():
+            for tag in tags + [None]:
+                self.levels.setdefault(tag, {}).setdefault(0, IndexSet([])).add(number)
+                self.low[tag] = 0
+
+    def pick(self, tag, assigned, rng):
+        """Returns one of the least used questions of `tag`, or of any tag
+        if None, among those not in `assigned`."""
+        levels = self.levels[tag]
+        level = self.low[tag]
+        top = max(levels)
+
+        while level <= top:
+            bucket = levels.get(level)
+            level += 1
+
+            if not bucket:
+                continue
+
+            for _ in range(self.PROBES):
+                number = bucket.choice(rng)
+
+                if number not in assigned:
+                    return number
+
+            free = [x for x in bucket.items if x not in assigned]
+
+            if free:
+                return rng.choice(free)
+
+        return None
+
+    def record(self, numbers):
+        for number in numbers:
+            level = self.count[number]
+            self.count[number] = level + 1
+
+            for tag in self.tags[number] + [None]:
+                levels = self.levels[tag]
+                levels[level].discard(number)
+                levels.setdefault(level + 1, IndexSet([])).add(number)
+
+                if not levels[level].size:
+                    del levels[level]
+
+                while self.low[tag] not in levels:
+                    self.low[tag] += 1
+
+
+def augment(bank, index, tag, assigned, visited):
+    """Finds an augmenting path that draws one more question for `tag`.
+
+    `assigned` maps the number of every drawn question to the tag it was
+    drawn for. A free question of `tag` is taken if there is one,
+    otherwise a question of `tag` is handed over from the tag that owns
+    it, which in turn looks for a replacement. Returns False if there is
+    no such path, leaving in `visited` the tags that compete for the same
+    questions."""
+    visited.add(tag)
+    free = index.free.get(tag)
+
+    if free and free.size:
+        number = free.items[0]
+        index.take(number)
+        assigned[number] = tag
+        return True
+
+    for q in bank.database.get(tag, []):
+        owner = assigned[q.number]
+        if owner not in visited and augment(bank, index, owner, assigned, visited):
+            assigned[q.number] = tag
+            return True
+
+    return False
+
+
+def check_restrictions(bank):
+    """Checks once per bank that every test can meet the restrictions.
+
+    This is a matching between tag slots and questions, where each
+    question counts for one tag only. Raises ValueError naming the tags
+    whose restrictions cannot be met together."""
+    total = bank.restrictions['total']
+    demands = tag_demands(bank)
+
+    if total > len(bank.questions_by_id):
+        raise ValueError('The master has %i questions, but `total` is %i' %
+                         (len(bank.questions_by_id), total))
+
+    if sum(demands.values()) > total:
+        raise ValueError('The tag restrictions ask for %i questions, but '
+                         '`total` is %i' % (sum(demands.values()), total))
+
+    index = TagIndex(bank)
+    assigned = {}
+
+    for tag in sorted(demands, key=bank.restrictions_order.get):
+        for _ in range(demands[tag]):
+            visited = set()
+
+            if augment(bank, index, tag, assigned, visited):
+                continue
+
+            tags = sorted(visited, key=bank.restrictions_order.get)
+            supply = set(q.number for t in tags
+                         for q in bank.database.get(t, []))
+
+            raise ValueError(u'Tags %s ask for %i questions, but only %i '
+                             u'questions have any of them' %
+                             (u', '.join(tags),
+                              sum(demands[t] for t in tags), len(supply)))
+
+
+def draw_questions(bank, index, rng, usage=None):
+    """Draws the questions of a test, at random, or the least used ones
+    first with a `Usage`. Returns the tag each one was drawn for, by
+    question number."""
+    total = bank.restrictions['total']
+    pending = tag_demands(bank)
+    assigned = {}
+
+    while pending:
+        tag = rng.choice(sorted(pending))
+        free = index.free.get(tag)
+
+        if free and free.size:
+            number = usage.pick(tag, assigned, rng) if usage else free.choice(rng)
+            index.take(number)
+            assigned[number] = tag
+        elif not augment(bank, index, tag, assigned, set()):
             raise ValueError('Could not fullfill a restriction '
                              'with tag "%s"' % tag)
-        i = random.choice(range(len(base[tag])))
-        q = base[tag].pop(i)
 
-        print('base[%s]' % tag, base[tag], bool(base[tag]))
+        pending[tag] -= 1
 
-        if not base[tag]:
-            base.pop(tag)
+        if not pending[tag]:
+            pending.pop(tag)
 
-        if args and not args.dont_shuffle_options:
-            q = q.shuffle()
+    while len(assigned) < total:
+        if not index.open.size:
+            raise ValueError('Could not complete test')
 
-        if debug > 1:
-            print(u'Selection question:\n%s' % str(q))
-        print('')
-
-        return q
-
-    while len(test) < total and tries < 10 * total:
-        print('test', test)
-        if res:
-            tag = random.choice(res.keys())
-            q = get_question(tag)
-            res[tag] -= 1
-            if not res[tag]:
-                res.pop(tag)
+        if usage:
+            number = usage.pick(None, assigned, rng)
+            tag = index.tags[number][0]
         else:
-            tag = random.choice(base.keys())
-            q = get_question(tag)
+            tag = index.open.choice(rng)
+            number = index.free[tag].choice(rng)
+
+        index.take(number)
+        assigned[number] = tag
+
+    return assigned
+
+
+# Tests drawn for each test number before giving up on keeping it apart
+# from its neighbours.
+SPACING_ATTEMPTS = 50
+
+
+class SimilarityIndex(object):
+    """Keeps the last `window` tests drawn, to tell how much a new test
+    overlaps with its neighbours.
+
+    Each test is kept as a bitset of its questions, so the questions two
+    tests share are a single AND, and only those are compared for the
+    order of their options. The overlap of two tests counts a half for
+    each question they share, and another half if its options are in the
+    same order, over the number of questions of a test."""
+
+    def __init__(self, window, threshold):
+        self.recent = collections.deque(maxlen=window)
+        self.threshold = threshold
+        self.violations = 0
+
+    @staticmethod
+    def features(test):
+        bits = 0
+        orders = {}
+
+        for q in test:
+            bits |= 1 << q.number
+            orders[q.number] = tuple(q.order)
+
+        return bits, orders
+
+    def overlap(self, test):
+        bits, orders = self.features(test)
+        worst = 0.
+
+        for other_bits, other_orders in self.recent:
+            shared = bin(bits & other_bits).count('1')
+
+            if not shared:
+                continue
+
+            same = len([n for n, o in orders.iteritems() if other_orders.get(n) == o])
+            worst = max(worst, (shared + same) / (2. * max(len(orders), len(other_orders))))
+
+        return worst
+
+    def add(self, test, overlap):
+        self.recent.append(self.features(test))
+
+        if overlap > self.threshold:
+            self.violations += 1
+
+
+def generate_quiz(bank, args=None, rng=random, index=None, spacing=None, usage=None,
+                  timer=timings.NONE):
+    """Draws the questions of a single test.
+
+    Assumes `check_restrictions` passed for `bank`. Each pick for a
+    restricted tag takes a free question of that tag, and when none is
+    left an augmenting path reassigns the previous picks, so a feasible
+    master never needs to retry. Pass the same `index` to draw many
+    tests from a bank without rebuilding it.
+
+    With a `SimilarityIndex` as `spacing`, tests are drawn until one
+    overlaps with the last ones by no more than its threshold, or the
+    least overlapping of `SPACING_ATTEMPTS` is taken. With a `Usage`, the
+    least used questions are drawn first, and the test is counted in it."""
+    if index is None:
+        index = TagIndex(bank)
+
+    if spacing is None:
+        test = draw_quiz(bank, args, rng, index, usage, timer)
+
+        if usage:
+            usage.record(q.number for q in test)
+
+        return test
+
+    best = None
+
+    for _ in range(SPACING_ATTEMPTS):
+        test = draw_quiz(bank, args, rng, index, usage, timer)
+        overlap = spacing.overlap(test)
+
+        if best is None or overlap < best[0]:
+            best = overlap, test
+
+        if overlap <= spacing.threshold:
+            break
+
+    spacing.add(best[1], best[0])
+
+    if usage:
+        usage.record(q.number for q in best[1])
+
+    return best[1]
+
+
+def draw_quiz(bank, args, rng, index, usage=None, timer=timings.NONE):
+    try:
+        with timer.phase('select'):
+            assigned = draw_questions(bank, index, rng, usage)
+    finally:
+        index.reset()
 
-        test.add(q)
+    with timer.phase('shuffle'):
+        return shuffle_quiz(bank, [bank.questions_by_id[number] for number in sorted(assigned)], args, rng)
 
-    if len(test) < total:
-        raise ValueError('Could not complete test')
 
-    test = list(test)
-    random.shuffle(test)
+def shuffle_quiz(bank, test, args, rng):
+    """Puts the questions drawn for a test, and their options, in their
+    final order."""
+    rng.shuffle(test)
+
+    if args and not args.dont_shuffle_options:
+        test = [q.shuffle(rng) for q in test]
+
+    if debug > 1:
+        for q in test:
+            print(u'Selection question:\n%s' % str(q))
 
-    print('restictions order', restrictions_order)
     if args and args.dont_shuffle_tags:
-        test.sort(key=lambda q: restrictions_order.get(q.tags[0], float('inf')))
+        test.sort(key=lambda q: bank.restrictions_order.get(q.tags[0], float('inf')))
 
     if args and args.sort_questions:
         test.sort(key=lambda q: q.number)
@@ -420,81 +1020,339 @@ def generate_quiz(args=None):
     return test
 
 
-def generate(n, args):
-    # Guaranteeing reproducibility
-    seed = args.seed or random.randint(1, 2 ** 32)
-    random.seed(seed)
+def exam_seed(seed, i):
+    """Derives the seed of test `i` from the seed of the version, so any
+    test can be drawn again on its own."""
+    return int(hashlib.sha1('%i/%i' % (seed, i)).hexdigest()[:16], 16)
+
+
+def splitmix(x):
+    """The SplitMix64 finalizer over an array of uint64."""
+    import numpy as np
+
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def batch_keys(seeds, stream, width):
+    """Returns `width` random keys for each of `seeds`. The keys are a hash
+    of the seed, the `stream` and their column, so each row only depends on
+    its own seed."""
+    import numpy as np
+
+    base = splitmix(seeds ^ np.uint64(stream))
+    return splitmix(base[:, None] + np.arange(width, dtype=np.uint64))
+
+
+def generate_batch(bank, indices, args, seed, timer=timings.NONE):
+    """Draws the tests numbered `indices` at once as NumPy arrays.
+
+    Returns `selection`, with the numbers of the questions of each test
+    in their final order, and `order`, with the permutation of the options
+    of each of those questions, padded with -1. Only the tag restricted
+    draw runs per test; shuffling the questions and the options of all
+    the tests is done with whole-array operations, using keys hashed from
+    the seed of each test."""
+    import numpy as np
+
+    index = TagIndex(bank)
+    total = bank.restrictions['total']
+    questions = bank.questions
+    drawn = indices
+    usage = None
 
-    text_template = jinja2.Template(open(args.text_template).
-                                    read().decode('utf8'))
-    answer_template = jinja2.Template(open(args.answer_template).
-                                      read().decode('utf8'))
-    sol_template = jinja2.Template(open('templates/solution_template.txt').
-                                   read().decode('utf8'))
-    master_template = jinja2.Template(open(args.master_template).
-                                      read().decode('utf8'))
+    if args.balanced and indices:
+        # Each test depends on the ones before it.
+        drawn = range(max(indices) + 1)
+        usage = Usage(index)
 
-    questions = set()
-    for qs in database.values():
-        for q in qs:
-            questions.add(q)
+    selection = np.empty((len(drawn), total), dtype=np.int32)
 
-    questions = sorted(questions, key=lambda q: q.number)
+    for row, i in enumerate(drawn):
+        try:
+            with timer.phase('select'):
+                assigned = draw_questions(bank, index, random.Random(exam_seed(seed, i)), usage)
+                selection[row] = sorted(assigned)
+        finally:
+            index.reset()
 
-    if not args.dont_generate_master:
-        master_file = open('generated/v{0}/Master.tex'.format(test_id), 'w')
-        master_file.write(master_template.render(test=questions,
-                          header=args.title).encode('utf8'))
-        master_file.close()
+        if usage:
+            usage.record(assigned)
 
-    sol_file = open('generated/v{0}/grader.txt'.format(test_id), 'w')
-    sol_file.write(sol_template.render(test=questions,
-                   test_id=test_id, questions_value=args.questions_value).encode('utf8'))
-    sol_file.close()
+    if usage:
+        selection = selection[indices]
 
-    order = {}
+    n = len(indices)
+    seeds = [exam_seed(seed, i) for i in indices]
 
-    answers = []
+    start = time.time()
 
-    for i in range(n):
+    seeds = np.array(seeds, dtype=np.uint64)
+    rows = np.arange(n)[:, None]
+
+    if args.sort_questions:
+        pass
+    elif args.dont_shuffle_tags:
+        rank = np.zeros(bank.count + 1, dtype=np.int32)
+        for q in questions:
+            rank[q.number] = bank.restrictions_order.get(q.tags[0], len(bank.restrictions_order))
+        keys = (batch_keys(seeds, 0, total), rank[selection])
+        selection = selection[rows, np.lexsort(keys, axis=1)]
+    else:
+        selection = selection[rows, np.argsort(batch_keys(seeds, 0, total), axis=1)]
+
+    width = max(len(q.options) for q in questions)
+    order = np.full((n * total, width), -1, dtype=np.int32)
+
+    # Group the slots of all the tests by question, so each question
+    # shuffles its options for every test it appears in at once.
+    flat = selection.ravel()
+    slots = np.argsort(flat, kind='mergesort')
+    bounds = np.searchsorted(flat[slots], [q.number for q in questions] +
+                             [bank.count + 1])
+
+    for j, q in enumerate(questions):
+        used = slots[bounds[j]:bounds[j + 1]]
+        k = len(q.options)
+        perms = np.tile(np.arange(k, dtype=np.int32), (len(used), 1))
+        free = np.array([i for i, o in enumerate(q.options) if not o[1]])
+
+        if not args.dont_shuffle_options and len(free) > 1:
+            keys = batch_keys(seeds[used // total], q.number, len(free))
+            perms[:, free] = free[np.argsort(keys, axis=1)]
+
+        order[used, :k] = perms
+
+    # The options of all the tests are shuffled at once, so this is a
+    # single run for the whole batch.
+    timer.add('shuffle', time.time() - start)
+
+    return selection, order.reshape((n, total, width))
+
+
+def batch_tests(bank, test_id, indices, selection, order):
+    """Builds the tests and their `scanresults.Test` records from the
+    arrays returned by `generate_batch`."""
+    for i, numbers, perms in zip(indices, selection.tolist(), order.tolist()):
+        test = []
+        records = []
+
+        for number, perm in zip(numbers, perms):
+            q = bank.questions_by_id[number]
+            perm = perm[:len(q.options)]
+            test.append(ExamQuestion(q, perm))
+            records.append(scanresults.Question(q.number, len(perm),
+                                                q.multiple, order=perm))
+
+        yield i, test, scanresults.Test(test_id, i, records)
+
+
+def quiz_tests(bank, indices, args, seed, test_id, timer=timings.NONE):
+    """Draws the tests numbered `indices` one at a time, each one from its
+    own seed, along with their `scanresults.Test` records.
+
+    With --max-overlap or --balanced each test depends on the ones before
+    it, so all of them are drawn, from test 0, and only those in `indices`
+    returned."""
+    index = TagIndex(bank)
+    spacing = None
+    usage = None
+    wanted = None
+
+    if args.max_overlap is not None:
+        spacing = SimilarityIndex(args.overlap_window, args.max_overlap)
+
+    if args.balanced:
+        usage = Usage(index)
+
+    if (spacing or usage) and indices:
+        wanted = set(indices)
+        indices = range(max(indices) + 1)
+
+    for i in indices:
         if debug:
             print('Generating quiz number %i' % i)
 
-        test = generate_quiz(args)
-        # order[i] = dict(exam_id=test_id, id=i, options=[])
-        order[i] = scanresults.Test(test_id, i, [q.convert() for q in test])
-        generate_qrcode(i, test)
+        test = generate_quiz(bank, args, random.Random(exam_seed(seed, i)), index, spacing, usage, timer)
+
+        if wanted is None or i in wanted:
+            yield i, test, scanresults.Test(test_id, i, [q.convert() for q in test])
 
-        if not args.dont_generate_text:
-            text_file = open('generated/v{0}/Test-{1:04}.tex'.format(test_id, i), 'w')
+    if spacing and spacing.violations:
+        print('Warning: %i tests overlap with their neighbours by more than %g. '
+              'The master may not have enough questions for --max-overlap.'
+              % (spacing.violations, spacing.threshold))
 
-            text_file.write(text_template.render(
-                            test=test, number=i, header=args.title).encode('utf8'))
-            text_file.close()
 
-        answers.append(dict(test=list(enumerate(test)), number=i, seed=seed, max=max(len(q.options) for q in test)))
+def shard_indices(n, shard, shards, answers_per_page=1):
+    """Returns the numbers of the tests built by shard `shard` (counted from
+    1) out of `shards`. Shards take whole answer pages, so no answer sheet
+    is split between two of them."""
+    pages = (n + answers_per_page - 1) // answers_per_page
+    first = pages * (shard - 1) // shards * answers_per_page
+    last = min(n, pages * shard // shards * answers_per_page)
+    return range(first, last)
 
-        if len(answers) == args.answers_per_page or i == n - 1:
-            answer_file = open('generated/v{0}/Answer-{1:04}.tex'.format(test_id, i / args.answers_per_page), 'w')
-            answer_file.write(answer_template.render(answers=answers).encode('utf8'))
-            answer_file.close()
-            answers = []
 
-    scanresults.dump(order, 'generated/v{0}/order.json'.format(test_id))
+def page_indices(indices, n, answers_per_page=1):
+    """Returns the numbers of the tests on the same answer pages as the
+    tests `indices`, out of `n`."""
+    pages = sorted(set(i // answers_per_page for i in indices))
+    return [i for page in pages
+            for i in range(page * answers_per_page, min(n, (page + 1) * answers_per_page))]
 
-    with open('generated/v{0}/seed'.format(test_id), 'w') as fp:
-        fp.write(str(seed) + '\n')
+
+# The options that decide which tests the seed of a version gives and how
+# their answer sheets are laid out, with their defaults.
+VERSION_OPTIONS = {
+    'answers_per_page': 1,
+    'balanced': False,
+    'batch': False,
+    'dont_shuffle_options': False,
+    'dont_shuffle_tags': False,
+    'max_overlap': None,
+    'overlap_window': 1,
+    'sort_questions': False,
+}
+
+
+def version_options(args):
+    """Returns the options in `args` a version must be generated again
+    with, so its tests come out the same."""
+    return dict((name, getattr(args, name)) for name in VERSION_OPTIONS)
+
+
+def generate(bank, n, args, test_id, indices=None, written=None, folder=None,
+             timer=timings.NONE):
+    """Generates the tests of version `test_id`, numbered from 0 to `n` - 1
+    or only those in `indices`. Each test is drawn from a seed derived from
+    the version seed and its number, so with the same seed any subset of
+    the tests comes out the same as in the whole version.
+
+    `written` is called with the path of each LaTeX file as soon as it is
+    complete, so it can be compiled while the next ones are written.
+
+    The files go to `folder`, by default the folder of the version, and
+    the time of each phase to `timer`. The seed and the options the tests
+    depend on are saved with them, to generate the version again."""
+    # Guaranteeing reproducibility
+    seed = args.seed or random.randint(1, 2 ** 32)
+
+    if indices is None:
+        indices = range(n)
+
+    folder = folder or 'generated/v{0}'.format(test_id)
+
+    def dst(path):
+        return os.path.join(folder, path)
+
+    check_restrictions(bank)
+
+    text_template = load_template(args.text_template)
+    answer_template = load_template(args.answer_template)
+    sol_template = load_template(args.solution_template)
+    master_template = load_template(args.master_template)
+
+    questions = bank.questions
+
+    def done(path):
+        if written:
+            written(path)
+
+    # Started first, so its processes fork before `written` starts any
+    # threads.
+    pool, codes = build_qrcodes(test_id, indices, args.vector_qrcodes, args.jobs, folder, timer)
+
+    try:
+        modules = {}
+
+        if not args.dont_generate_master:
+            with timer.phase('render'):
+                master_file = open(dst('Master.tex'), 'w')
+                master_file.write(master_template.render(test=questions,
+                                  header=args.title).encode('utf8'))
+                master_file.close()
+            done(master_file.name)
+
+        sol_file = open(dst('grader.txt'), 'w')
+        sol_file.write(sol_template.render(test=questions,
+                       test_id=test_id, questions_value=args.questions_value).encode('utf8'))
+        sol_file.close()
+
+        order = {}
+
+        answers = []
+
+        def qrcode_latex(number, width='2cm'):
+            if args.vector_qrcodes:
+                return qrcode_tex(modules[number], width)
+
+            return '\\includegraphics[width=%s]{qrcode-%i.png}' % (width, number)
+
+        if args.batch:
+            tests = batch_tests(bank, test_id, indices, *generate_batch(bank, indices, args, seed, timer))
+        else:
+            tests = quiz_tests(bank, indices, args, seed, test_id, timer)
+
+        pages = [i / args.answers_per_page for i in indices] + [None]
+        progress = timings.Progress(len(indices), 'tests')
+
+        for j, ((i, test, record), (_, code)) in enumerate(itertools.izip(tests, codes)):
+            # order[i] = dict(exam_id=test_id, id=i, options=[])
+            order[i] = record
+            modules[i] = code
+
+            if not args.dont_generate_text:
+                with timer.phase('render'):
+                    text_file = open(dst('Test-{0:04}.tex'.format(i)), 'w')
+
+                    text_file.write(text_template.render(
+                                    test=test, number=i, header=args.title,
+                                    qrcode=qrcode_latex).encode('utf8'))
+                    text_file.close()
+                done(text_file.name)
+
+            answers.append(dict(test=list(enumerate(test)), number=i, seed=seed, max=max(len(q.options) for q in test)))
+
+            if pages[j] != pages[j + 1]:
+                with timer.phase('render'):
+                    answer_file = open(dst('Answer-{0:04}.tex'.format(pages[j])), 'w')
+                    answer_file.write(answer_template.render(answers=answers, qrcode=qrcode_latex).encode('utf8'))
+                    answer_file.close()
+                done(answer_file.name)
+                answers = []
+
+            progress.step()
+
+        progress.done()
+
+        scanresults.dump(order, dst('order.json'))
+
+        with open(dst('seed'), 'w') as fp:
+            fp.write(str(seed) + '\n')
+
+        with open(dst('options.json'), 'w') as fp:
+            json.dump(version_options(args), fp, indent=2, sort_keys=True)
+    finally:
+        # Also when a test or template fails, so no worker is left behind.
+        if pool:
+            pool.terminate()
+            pool.join()
 
 
 if __name__ == '__main__':
     args_parser = argparse.ArgumentParser(description="Parses a master file and generates tests.")
     args_parser.add_argument('master', metavar="PATH", help="Path to the master file that contains the test description.")
+    args_parser.add_argument('-s', '--seed', type=int, default=None, help='A custom seed for the random generator.')
     args_parser.add_argument('-c', '--tests-count', metavar='N', help="Number of actual tests to generate. If not supplied, only the master file will be generated.", type=int, default=0)
     args_parser.add_argument('-a', '--answers-per-page', help="Number of answer sections to generate per page. By default is 1. It is up to you to ensure all them fit right in your template.", metavar='N', type=int, default=1)
     args_parser.add_argument('-t', '--title', help="Title of the test.", default="")
     args_parser.add_argument('--answer-template', help="Template for the answers sheets.", default="latex/answer_template.tex")
     args_parser.add_argument('--master-template', help="Template for the master sheet.", default="latex/master_template.tex")
     args_parser.add_argument('--text-template', help="Template for the text sheets.", default="latex/text_template.tex")
+    args_parser.add_argument('--solution-template', help="Template for the grader sheet.", default="latex/solution_template.txt")
     args_parser.add_argument('-v', '--questions-value', help="Default value for each question.", metavar='N', type=float, default=1.)
     args_parser.add_argument('--dont-shuffle-tags', help="Disallow shuffling of tags.", action='store_true')
     args_parser.add_argument('--sort-questions', help="After selecting questions, put them in the same order as in the master.", action='store_true')
@@ -503,6 +1361,13 @@ if __name__ == '__main__':
     args_parser.add_argument('--election', help="Toggle all options for election mode.", action='store_true')
     args_parser.add_argument('--questionnaire', help="Toggle all options for questionnaire mode.", action='store_true')
     args_parser.add_argument('--dont-generate-master', help="Do not generate a master file.", action='store_true')
+    args_parser.add_argument('-j', '--jobs', metavar='N', type=int, default=None, help="Number of worker processes. By default, one per CPU.")
+    args_parser.add_argument('--vector-qrcodes', help="Draw the QR codes with LaTeX rules instead of PNG files. Needs templates that place them with `qrcode(number)`.", action='store_true')
+    args_parser.add_argument('--batch', help="Draw all the tests at once with NumPy. Faster for large versions, but gives different tests than the default mode for the same seed.", action='store_true')
+    args_parser.add_argument('--balanced', help="Draw the least used questions first, so all of them appear in about as many tests.", action='store_true')
+    args_parser.add_argument('--max-overlap', metavar='FRACTION', type=float, default=None, help="Keep the overlap of each test with the previous ones, in questions and order of their options, under FRACTION.")
+    args_parser.add_argument('--overlap-window', metavar='N', type=int, default=1, help="Number of previous tests each test is kept apart from with --max-overlap. By default 1.")
+    args_parser.add_argument('--timings', action='store_true', help="Print how long each phase of the generation took.")
 
     args = args_parser.parse_args()
 
@@ -523,14 +1388,26 @@ if __name__ == '__main__':
     if not os.path.exists('generated'):
         os.mkdir('generated')
 
+    test_id = 1
+
     for d in os.listdir('generated'):
+        if not re.match(r'v[0-9]+$', d):
+            continue
+
         num = int(d[1:])
         if num >= test_id:
             test_id = num + 1
 
     os.mkdir('generated/v{0}'.format(test_id))
 
-    parser(master_path)
-    generate(args.tests_count, args)
+    timer = timings.Timings()
+
+    with timer.phase('parse'):
+        bank = parser(args.master)
+
+    generate(bank, args.tests_count, args, test_id, timer=timer)
 
     print('Generated v{0}'.format(test_id))
+
+    if args.timings:
+        print(timer.report())
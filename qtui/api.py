@@ -5,7 +5,7 @@
 autoexam api
 """
 
-import os, subprocess, random, jinja2
+import os, subprocess, random
 import sys
 import autoexam
 from os import system as run
@@ -131,7 +131,8 @@ def validate_project(project):
 
 
 def render_master(project, template_path):
-    return jinja2.Template(open(template_path).read().decode('utf-8')).render(project=project)
+    import gen
+    return gen.load_template(template_path).render(project=project)
 
 
 # def add_scan_event_subscriber(obj):
@@ -125,8 +125,8 @@ class MainWindow(QMainWindow):
                 if exists(master_filename):
                     print 'there is no project, but there is a master file that could be imported'
                     import gen
-                    gen.parser(master_filename)
-                    project = model.load_project_from_master(gen.questions_by_id, gen.restrictions)
+                    bank = gen.parser(master_filename)
+                    project = model.load_project_from_master(bank.questions_by_id, bank.restrictions)
 
                     self.project = project
                     self.project_path = __project_file_path__
@@ -76,6 +76,7 @@ def main():
     tests = {}
     #While user does not press the q key
     while cv2.waitKey(1) & 0xFF != ord('q'):
+        source.show()
         #Get the scan report of the source image
         report = scanner.scan(source)
         #if test recognized OK
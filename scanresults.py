@@ -1,5 +1,6 @@
 import os
 import json
+import threading
 
 def enum(**enums):
     return type('Enum', (), enums)
@@ -59,6 +60,13 @@ class MarkersError(object):
     def __str__(self):
         return "There was an error with the detection of the markers"
 
+class ScanError(object):
+    """Error raised while recognizing an image"""
+    def __init__(self, error):
+        self.error = error
+    def __str__(self):
+        return "The image could not be scanned: %s"%self.error
+
 class QuestionError(object):
     """docstring for QuestionError"""
     def __init__(self, q, msg):
@@ -154,6 +162,21 @@ class Test(object):
         result["warnings"] = [w.to_dict() for w in self.warnings]
         return result
 
+class ResultSink(object):
+    """Collects the tests scanned by several cameras at once, keeping the
+    first scan of each test"""
+    def __init__(self):
+        self.tests = {}
+        self.lock = threading.Lock()
+
+    def add(self, test):
+        """Stores the test if it was not scanned before -> bool"""
+        with self.lock:
+            if test.id in self.tests:
+                return False
+            self.tests[test.id] = test
+            return True
+
 def dump(tests, filename, overwrite = False):
     to_serialize = {}
     all_tests = {}
@@ -165,12 +188,12 @@ def dump(tests, filename, overwrite = False):
     for (k,v) in tests.items():
         all_tests[k]=v
     #transform objects to dictionaries to store them in json format
-    for (k,v) in all_tests.items():
+    for (k,v) in sorted(all_tests.items()):
         print('Saving test: {0}'.format(k))
         to_serialize[k]=v.to_dict();
-    #dump in json format
+    #dump in json format, sorted by test so the file does not depend on the scan order
     f = file(filename,'w')
-    json.dump(to_serialize, f, indent=4)
+    json.dump(to_serialize, f, indent=4, sort_keys=True)
     f.close()
 
 def parse(filename):
@@ -16,12 +16,15 @@ def mean_and_stdev(samples):
 
 
 def build_stats(args):
-	gen.parser()
+	bank = gen.parser(args.master)
+	gen.check_restrictions(bank)
+	index = gen.TagIndex(bank)
+	usage = gen.Usage(index) if args.balanced else None
 
 	print('Running %i simulations' % (args.samples))
 
 	questions_distribution = collections.defaultdict(lambda: 0)
-	tags_distribution = {t:[] for t in gen.database}
+	tags_distribution = {t:[] for t in bank.database}
 	grades_distribution = collections.defaultdict(lambda: 0)
 
 	for i in range(args.samples):
@@ -29,7 +32,7 @@ def build_stats(args):
 			print('.', end='')
 			sys.stdout.flush()
 
-		test = gen.generate_quiz()
+		test = gen.generate_quiz(bank, index=index, usage=usage)
 
 		tags = collections.defaultdict(lambda: 0)
 
@@ -0,0 +1,549 @@
+#! /usr/bin/python
+#-*-coding: utf8-*-
+
+"""
+Compilation of the LaTeX sources of a generated version.
+"""
+
+import os
+import re
+import shutil
+import Queue
+import hashlib
+import threading
+import subprocess
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import timings
+
+# Bump this to invalidate every PDF in the build caches.
+CACHE_FORMAT = 1
+
+GRAPHICS_RE = re.compile(r'\\includegraphics(?:\[[^\]]*\])?\{([^}]*)\}')
+GRAPHICS_EXTENSIONS = ['', '.png', '.pdf', '.jpg']
+
+# Written to the log of a combined document before each of its parts,
+# followed by the name of the part and the page it starts at.
+PAGE_MARK = '[AUTOEXAM-PART]'
+PAGE_MARK_RE = re.compile(re.escape(PAGE_MARK) + r' (\S+) ([0-9]+)')
+
+
+def log_path(tex):
+    return os.path.splitext(tex)[0] + '.compile.log'
+
+
+def run_pdflatex(arguments, log, cwd=None):
+    try:
+        return subprocess.call(['pdflatex', '-interaction=nonstopmode'] + arguments,
+                               stdout=log, stderr=subprocess.STDOUT, cwd=cwd or None)
+    except OSError as e:
+        log.write('Could not run pdflatex: %s\n' % e)
+        return -1
+
+
+def compile_tex(tex, fmt=None, timer=timings.NONE):
+    """Runs pdflatex on `tex` in its folder, writing its output to a log
+    of its own. Returns the file name and whether it compiled.
+
+    If `fmt` is given, the document is compiled with that precompiled
+    preamble, and compiled again the normal way if that fails."""
+    folder, name = os.path.split(tex)
+
+    with open(log_path(tex), 'w') as log, timer.phase('compile'):
+        if fmt and run_pdflatex(['-fmt=' + os.path.basename(fmt), name], log, folder) == 0:
+            return tex, True
+
+        return tex, run_pdflatex([name], log, folder) == 0
+
+
+def read_preamble(tex):
+    with open(tex) as fp:
+        source = fp.read()
+
+    i = source.find('\\begin{document}')
+
+    if i < 0:
+        return None
+
+    return source[:i]
+
+
+def dump_format(name, preamble):
+    """Dumps `preamble` into the format `name`.fmt. Returns whether it
+    succeeded."""
+    folder, base = os.path.split(name)
+
+    with open(name + '.tex', 'w') as fp:
+        fp.write(preamble)
+        # With the preamble already loaded, make the document skip its own
+        # preamble up to \begin{document}.
+        fp.write('\n\\long\\def\\documentclass#1\\begin#2{\\begin{#2}}\n\\dump\n')
+
+    with open(log_path(name + '.tex'), 'w') as log:
+        code = run_pdflatex(['-ini', '-jobname=' + base, '&pdflatex', base + '.tex'], log, folder)
+
+    os.remove(name + '.tex')
+
+    return code == 0 and os.path.exists(name + '.fmt')
+
+
+def dump_formats(files, pool):
+    """Dumps a format for every preamble shared by several of `files`.
+    Returns the format to use for each file."""
+    groups = {}
+
+    for tex in files:
+        preamble = read_preamble(tex)
+
+        if preamble is not None:
+            groups.setdefault(preamble, []).append(tex)
+
+    preambles = [p for p, group in groups.items() if len(group) > 1]
+    names = ['preamble-' + hashlib.sha1(p).hexdigest()[:8] for p in preambles]
+    dumped = pool.map(lambda args: dump_format(*args), zip(names, preambles))
+
+    formats = {}
+
+    for preamble, name, ok in zip(preambles, names, dumped):
+        if ok:
+            for tex in groups[preamble]:
+                formats[tex] = name
+
+    return formats
+
+
+def build_key(tex, folders=None):
+    """Hashes the source of `tex` together with the images it includes,
+    which is everything its PDF depends on besides the TeX installation.
+
+    Images are looked for in the first of `folders` that has them, by
+    default in the folder of `tex`."""
+    with open(tex) as fp:
+        source = fp.read()
+
+    key = hashlib.sha1('%i\n' % CACHE_FORMAT)
+    key.update(source)
+
+    for path in GRAPHICS_RE.findall(source):
+        key.update('\n' + path + '\n')
+        image = find_image(path, folders or [os.path.dirname(tex)])
+
+        if image:
+            with open(image, 'rb') as fp:
+                key.update(fp.read())
+
+    return key.hexdigest()
+
+
+def find_image(path, folders):
+    for folder in folders:
+        for ext in GRAPHICS_EXTENSIONS:
+            if os.path.isfile(os.path.join(folder, path + ext)):
+                return os.path.join(folder, path + ext)
+
+    return None
+
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+
+
+def cache_version(folder, cache):
+    """Fills the folder `cache` with the PDFs of the version built before
+    in `folder`, keyed on their sources, so building it again only
+    compiles the files that changed."""
+    if not os.path.exists(cache):
+        os.makedirs(cache)
+
+    src = os.path.join(folder, 'src')
+
+    if not os.path.isdir(src):
+        return
+
+    for name in os.listdir(src):
+        base, ext = os.path.splitext(name)
+        pdf = os.path.join(folder, 'pdf', base + '.pdf')
+        log = os.path.join(folder, 'log', base + '.log')
+
+        if ext != '.tex' or not os.path.exists(pdf):
+            continue
+
+        # The sources were compiled in the version folder, and then moved
+        # to src/ along with the QR codes.
+        key = build_key(os.path.join(src, name), [folder, src])
+
+        if not os.path.exists(os.path.join(cache, key + '.pdf')):
+            link_or_copy(pdf, os.path.join(cache, key + '.pdf'))
+
+            # The log carries the page marks of combined documents.
+            if os.path.exists(log):
+                link_or_copy(log, os.path.join(cache, key + '.log'))
+
+
+def fetch_cached(tex, key, cache):
+    cached = os.path.join(cache, key + '.pdf')
+    base = os.path.splitext(tex)[0]
+
+    if not os.path.exists(cached):
+        return False
+
+    shutil.copy(cached, base + '.pdf')
+
+    # The log carries the page marks of combined documents.
+    if os.path.exists(os.path.join(cache, key + '.log')):
+        shutil.copy(os.path.join(cache, key + '.log'), base + '.log')
+
+    with open(log_path(tex), 'w') as log:
+        log.write('Reused %s from the build cache\n' % cached)
+
+    return True
+
+
+def store_cached(tex, key, cache):
+    pdf = os.path.splitext(tex)[0] + '.pdf'
+
+    if not os.path.exists(pdf):
+        return
+
+    # Copy under a temporary name first, so a concurrent build never
+    # picks up a half written PDF.
+    cached = os.path.join(cache, key)
+    log = os.path.splitext(tex)[0] + '.log'
+
+    if os.path.exists(log):
+        shutil.copy(log, cached + '.log.tmp')
+        os.rename(cached + '.log.tmp', cached + '.log')
+
+    shutil.copy(pdf, cached + '.pdf.tmp')
+    os.rename(cached + '.pdf.tmp', cached + '.pdf')
+
+
+def compile_all(files, jobs=None, precompile=False, cache=None, timer=timings.NONE):
+    """Compiles `files` with `jobs` pdflatex processes running at a time,
+    one per CPU by default. Returns the files that failed to compile.
+
+    With `precompile`, the preambles shared by several files are loaded
+    once into a format, and each file is compiled with its format.
+
+    `cache` is a folder of PDFs keyed on `build_key`: files found there
+    are copied instead of compiled, and new PDFs are added to it."""
+    keys = {}
+
+    if cache:
+        if not os.path.exists(cache):
+            os.makedirs(cache)
+
+        keys = dict((tex, build_key(tex)) for tex in files)
+        files = [tex for tex in files if not fetch_cached(tex, keys[tex], cache)]
+
+    if not files:
+        return []
+
+    # The work is done by the pdflatex processes, so plain threads are
+    # enough to keep them fed.
+    pool = ThreadPool(min(jobs or multiprocessing.cpu_count(), len(files)))
+    formats = {}
+
+    try:
+        if precompile:
+            formats = dump_formats(files, pool)
+
+        results = pool.map(lambda tex: compile_tex(tex, formats.get(tex), timer), files)
+    finally:
+        pool.close()
+        pool.join()
+
+        for name in set(formats.values()):
+            os.remove(name + '.fmt')
+
+    for tex, ok in results:
+        if ok and cache:
+            store_cached(tex, keys[tex], cache)
+
+    return [tex for tex, ok in results if not ok]
+
+
+def rasterize(pdf, folder, timer=timings.NONE):
+    """Renders every page of `pdf` into a JPEG file in `folder`."""
+    name = os.path.splitext(os.path.basename(pdf))[0]
+
+    try:
+        with timer.phase('rasterize'):
+            return subprocess.call(['pdftocairo', '-jpeg', pdf,
+                                    os.path.join(folder, name + '-scan')]) == 0
+    except OSError:
+        return False
+
+
+def note_error(tex, e):
+    try:
+        with open(log_path(tex), 'a') as log:
+            log.write('Could not build %s: %s\n' % (tex, e))
+    except IOError:
+        pass
+
+
+class Pipeline(object):
+    """Compiles LaTeX files while the rest of the version is still being
+    written, and rasterizes the PDFs of the answer sheets into `images`
+    while other files compile.
+
+    Files are fed with `put`, which blocks while `jobs` files are already
+    waiting, so writing never runs far ahead of compiling. `close` waits
+    for everything to finish and returns the files that failed.
+
+    `precompile` and `cache` work like in `compile_all`, except that a
+    preamble is dumped into a format as soon as a second file with it
+    shows up, and the files that show up while it is dumped are compiled
+    without it. If a file in `critical` fails, the files after it are not
+    compiled any more and `stopped` is set. The time of each compilation
+    and rasterization goes to `timer`."""
+
+    def __init__(self, jobs=None, precompile=False, cache=None, images=None,
+                 critical=(), timer=timings.NONE):
+        self.workers = jobs or multiprocessing.cpu_count()
+        self.precompile = precompile
+        self.cache = cache
+        self.images = images
+        self.critical = set(critical)
+        self.timer = timer
+
+        self.compiling = Queue.Queue(self.workers)
+        self.rasterizing = Queue.Queue(self.workers)
+        self.threads = []
+        self.rasterizers = []
+
+        self.lock = threading.Lock()
+        self.preambles = {}
+        self.formats = {}
+
+        self.count = 0
+        self.failed = []
+        self.stopped = False
+
+        if cache and not os.path.exists(cache):
+            os.makedirs(cache)
+
+    def start(self):
+        # Threads are only started with the first file, so that process
+        # pools created before that fork a single threaded process.
+        for target, threads in [(self.compile_worker, self.threads),
+                                (self.rasterize_worker, self.rasterizers)]:
+            for _ in range(self.workers):
+                thread = threading.Thread(target=target)
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+
+    def put(self, tex):
+        if not self.threads:
+            self.start()
+
+        self.count += 1
+        self.compiling.put(tex)
+
+    def format_for(self, tex):
+        preamble = read_preamble(tex)
+
+        if not self.precompile or preamble is None:
+            return None
+
+        with self.lock:
+            seen = self.preambles.get(preamble, 0)
+            self.preambles[preamble] = seen + 1
+
+            if seen != 1:
+                return self.formats.get(preamble)
+
+        # Dumped outside of the lock, so the other workers keep compiling.
+        name = os.path.join(os.path.dirname(tex),
+                            'preamble-' + hashlib.sha1(preamble).hexdigest()[:8])
+
+        if not dump_format(name, preamble):
+            return None
+
+        with self.lock:
+            self.formats[preamble] = name
+
+        return name
+
+    def build(self, tex):
+        key = None
+
+        if self.cache:
+            key = build_key(tex)
+
+            if fetch_cached(tex, key, self.cache):
+                return True
+
+        _, ok = compile_tex(tex, self.format_for(tex), self.timer)
+
+        if ok and key:
+            store_cached(tex, key, self.cache)
+
+        return ok
+
+    def compile_worker(self):
+        while True:
+            tex = self.compiling.get()
+
+            if tex is None:
+                return
+
+            if self.stopped:
+                continue
+
+            # A worker that dies leaves put and close blocked for good.
+            try:
+                ok = self.build(tex)
+            except Exception as e:
+                ok = False
+                note_error(tex, e)
+
+            if not ok:
+                with self.lock:
+                    self.failed.append(tex)
+                    self.stopped = self.stopped or tex in self.critical
+            elif self.images and os.path.basename(tex).startswith('Answer'):
+                self.rasterizing.put(os.path.splitext(tex)[0] + '.pdf')
+
+    def rasterize_worker(self):
+        while True:
+            pdf = self.rasterizing.get()
+
+            if pdf is None:
+                return
+
+            rasterize(pdf, self.images, self.timer)
+
+    def close(self):
+        for threads, queue in [(self.threads, self.compiling),
+                               (self.rasterizers, self.rasterizing)]:
+            for _ in threads:
+                queue.put(None)
+
+            for thread in threads:
+                thread.join()
+
+        for name in self.formats.values():
+            os.remove(name + '.fmt')
+
+        return sorted(self.failed)
+
+
+def split_source(tex):
+    """Returns the preamble and the body of `tex`, without the
+    \\begin{document} and \\end{document} lines."""
+    with open(tex) as fp:
+        source = fp.read()
+
+    start = source.find('\\begin{document}')
+    end = source.rfind('\\end{document}')
+
+    if start < 0 or end < start:
+        return None, None
+
+    return source[:start], source[start + len('\\begin{document}'):end]
+
+
+def combine_sources(files):
+    """Writes the documents of each kind in `files` (Answer-0000.tex,
+    Answer-0001.tex, ... make the kind `Answer`) into a single document
+    named after the kind, like `Answers.tex`, each one starting on a new
+    page. Kinds whose documents don't share the same preamble are left
+    alone. Returns the files combined into each new document."""
+    kinds = {}
+
+    for tex in files:
+        if '-' in tex:
+            kinds.setdefault(tex.split('-')[0], []).append(tex)
+
+    combined = {}
+
+    for kind, parts in sorted(kinds.items()):
+        sources = [split_source(tex) for tex in parts]
+        preambles = set(preamble for preamble, _ in sources)
+
+        if len(parts) < 2 or len(preambles) > 1 or None in preambles:
+            continue
+
+        name = kind + 's.tex'
+
+        with open(name, 'w') as fp:
+            fp.write(sources[0][0])
+            fp.write('\\begin{document}\n')
+
+            for tex, (_, body) in zip(parts, sources):
+                fp.write('\\immediate\\write-1{%s %s \\arabic{page}}\n' %
+                         (PAGE_MARK, os.path.splitext(tex)[0]))
+                fp.write(body)
+                fp.write('\n\\clearpage\n')
+
+            fp.write('\\immediate\\write-1{%s %s \\arabic{page}}\n' %
+                     (PAGE_MARK, os.path.splitext(name)[0]))
+            fp.write('\\end{document}\n')
+
+        combined[name] = parts
+
+    return combined
+
+
+def split_part(args):
+    combined, part, first, last = args
+    pattern = '%s-page-%%d.pdf' % part
+    pages = [pattern % p for p in range(first, last + 1)]
+
+    try:
+        code = subprocess.call(['pdfseparate', '-f', str(first), '-l', str(last),
+                                combined, pattern])
+
+        if code == 0 and len(pages) == 1:
+            os.rename(pages[0], part + '.pdf')
+        elif code == 0:
+            code = subprocess.call(['pdfunite'] + pages + [part + '.pdf'])
+    except OSError:
+        code = -1
+
+    for page in pages:
+        if os.path.exists(page):
+            os.remove(page)
+
+    return part + '.tex', code == 0
+
+
+def split_pdf(name, parts, jobs=None):
+    """Splits the PDF of the combined document `name` back into a PDF for
+    each of its `parts`, using the page marks in its log. Returns the
+    parts that could not be split out, including those without marks."""
+    base = os.path.splitext(name)[0]
+
+    if not os.path.exists(base + '.log'):
+        return list(parts)
+
+    with open(base + '.log') as fp:
+        marks = [(part, int(page)) for part, page in PAGE_MARK_RE.findall(fp.read())]
+
+    ranges = [(base + '.pdf', part, page, next_page - 1)
+              for (part, page), (_, next_page) in zip(marks, marks[1:])
+              if part + '.tex' in parts]
+
+    # A part is only known to end where the next one starts.
+    marked = set(part + '.tex' for _, part, _, _ in ranges)
+    failed = [tex for tex in parts if tex not in marked]
+
+    if not ranges:
+        return failed
+
+    pool = ThreadPool(min(jobs or multiprocessing.cpu_count(), len(ranges)))
+
+    try:
+        results = pool.map(split_part, ranges)
+    finally:
+        pool.close()
+        pool.join()
+
+    return sorted(failed + [tex for tex, ok in results if not ok])
@@ -0,0 +1,155 @@
+#! /usr/bin/python
+#-*-coding: utf8-*-
+
+"""
+Per-phase timers for the generation of a version.
+
+Every phase keeps the duration of each of its runs, so the summary can
+show how the time is spread and not only where it adds up:
+
+    timer = timings.Timings()
+
+    with timer.phase('render'):
+        ...
+"""
+
+import sys
+import json
+import time
+import threading
+import contextlib
+
+# The phases of `autoexam gen`, in the order they are reported.
+PHASES = ['parse', 'select', 'shuffle', 'render', 'qrcode', 'compile', 'rasterize']
+
+
+def percentile(values, p):
+    """The nearest-rank percentile `p` of the sorted `values`."""
+    return values[max(0, int(round(p / 100.0 * len(values))) - 1)]
+
+
+def ordered(phases):
+    return [name for name in PHASES if name in phases] + \
+        sorted(name for name in phases if name not in PHASES)
+
+
+class Timings(object):
+    """The durations of the phases of one generation. It is passed to
+    every step that is timed, and can be shared by their threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.started = time.time()
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.samples.setdefault(name, []).append(seconds)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def summary(self):
+        """Returns the count, total, mean, percentiles and maximum of the
+        durations of each phase, in seconds."""
+        with self.lock:
+            phases = dict((name, sorted(values)) for name, values in self.samples.items())
+
+        result = {}
+
+        for name, values in phases.items():
+            result[name] = dict(count=len(values),
+                                total=sum(values),
+                                mean=sum(values) / len(values),
+                                p50=percentile(values, 50),
+                                p90=percentile(values, 90),
+                                p99=percentile(values, 99),
+                                max=values[-1])
+
+        return result
+
+    def dump(self, filename):
+        with open(filename, 'w') as fp:
+            json.dump(dict(wall=time.time() - self.started, phases=self.summary()), fp,
+                      indent=4, sort_keys=True)
+
+    def report(self):
+        """Formats the summary as a table, one phase per line. Most phases
+        run in several processes at once, so their totals can add up to
+        more than the wall time."""
+        phases = self.summary()
+        columns = ['total', 'mean', 'p50', 'p90', 'p99', 'max']
+        lines = ['{0:<10} {1:>7} '.format('phase', 'count') +
+                 ' '.join('{0:>9}'.format(c) for c in columns)]
+
+        for name in ordered(phases):
+            row = phases[name]
+            lines.append('{0:<10} {1:>7} '.format(name, row['count']) +
+                         ' '.join('{0:>8.3f}s'.format(row[c]) for c in columns))
+
+        lines.append('wall time: {0:.3f}s'.format(time.time() - self.started))
+
+        return '\n'.join(lines)
+
+
+class NullTimings(Timings):
+    """Timings that keep nothing, for the steps run without any."""
+
+    def add(self, name, seconds):
+        pass
+
+
+# The default of the functions that take timings. It keeps no state.
+NONE = NullTimings()
+
+
+class Progress(object):
+    """Keeps a line on the terminal with the number of `things` done out of
+    `total` and the estimated time left."""
+
+    def __init__(self, total, things, stream=sys.stderr):
+        self.total = total
+        self.things = things
+        self.stream = stream
+        self.count = 0
+        self.start = time.time()
+        self.shown = 0
+        self.enabled = total > 0 and stream.isatty()
+
+    def step(self, count=1):
+        self.count += count
+        now = time.time()
+
+        if self.enabled and (now - self.shown > 0.2 or self.count == self.total):
+            self.shown = now
+            self.show(now - self.start)
+
+    def show(self, elapsed):
+        left = elapsed / self.count * (self.total - self.count)
+        self.stream.write('\r  {0}/{1} {2} ({3}%), {4} left   '.format(
+            self.count, self.total, self.things, 100 * self.count // self.total,
+            format_seconds(left)))
+        self.stream.flush()
+
+    def done(self):
+        if self.enabled:
+            self.stream.write('\n')
+            self.stream.flush()
+
+
+def format_seconds(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+
+    if hours:
+        return '{0}h{1:02}m'.format(hours, minutes)
+    elif minutes:
+        return '{0}m{1:02}s'.format(minutes, seconds)
+
+    return '{0}s'.format(seconds)